@@ -0,0 +1,127 @@
+# Shared helpers for the benchmark scripts in this directory: latency statistics, peak memory and saved baselines.
+#
+# Baselines are plain JSON files in benchmarks/baselines/<name>.json holding the summary of an earlier run. Comparing
+# against one flags a regression when a latency percentile grew, or the throughput dropped, by more than the
+# tolerance.
+
+import json
+import math
+import os
+import resource
+import sys
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+# Summary keys where a bigger number is worse, and where a smaller number is worse.
+HIGHER_IS_WORSE = ('p50_seconds', 'p99_seconds', 'peak_rss_kb')
+LOWER_IS_WORSE = ('throughput_per_second',)
+
+
+# Nearest rank percentile of an already sorted list.
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(sorted_values))) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+# Peak resident set size in KB of this process and of its (waited for) children, whichever is larger.
+def peak_rss_kb():
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+    # ru_maxrss is in bytes on macOS and in KB everywhere else.
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+# Summarise a list of per item latencies measured over elapsed wall clock seconds.
+def summarize(latencies, elapsed, failures=0):
+    latencies = sorted(latencies)
+    return dict(
+        count=len(latencies),
+        failures=failures,
+        elapsed_seconds=elapsed,
+        throughput_per_second=len(latencies) / elapsed if elapsed else 0.0,
+        p50_seconds=percentile(latencies, 50),
+        p99_seconds=percentile(latencies, 99),
+        max_seconds=latencies[-1] if latencies else 0.0,
+        peak_rss_kb=peak_rss_kb(),
+    )
+
+
+def save_baseline(name, summary):
+    if not os.path.isdir(BASELINE_DIR):
+        os.makedirs(BASELINE_DIR)
+    with open(os.path.join(BASELINE_DIR, '%s.json' % name), 'w') as f:
+        json.dump(summary, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+# Compare summary with the named baseline. Returns a list of human readable regressions, empty when there are none.
+def compare_baseline(name, summary, tolerance):
+    with open(os.path.join(BASELINE_DIR, '%s.json' % name)) as f:
+        baseline = json.load(f)
+
+    regressions = []
+    for key in HIGHER_IS_WORSE:
+        if key in baseline and summary[key] > baseline[key] * (1 + tolerance):
+            regressions.append('%s %.4g > baseline %.4g' % (key, summary[key], baseline[key]))
+    for key in LOWER_IS_WORSE:
+        if key in baseline and summary[key] < baseline[key] * (1 - tolerance):
+            regressions.append('%s %.4g < baseline %.4g' % (key, summary[key], baseline[key]))
+    return regressions
+
+
+# Set up the plugin loader and the collection finder the way the ansible CLIs do before running anything. Since
+# ansible-core 2.10 nothing under ansible.builtin (module_utils redirects, connection and action plugins) resolves
+# without the finder. Safe to call more than once, and a no-op on versions without collections.
+def init_ansible_plugins():
+    try:
+        from ansible.utils.collection_loader import AnsibleCollectionConfig
+    except ImportError:
+        return
+    if AnsibleCollectionConfig.collection_finder is not None:
+        return
+
+    try:
+        from ansible.plugins.loader import init_plugin_loader
+    except ImportError:
+        # Before ansible-core 2.15 the CLI installs the finder itself.
+        from ansible import constants as C
+        from ansible.utils.collection_loader._collection_finder import _AnsibleCollectionFinder
+        _AnsibleCollectionFinder(C.COLLECTIONS_PATHS, C.COLLECTIONS_SCAN_SYS_PATH)._install()
+    else:
+        init_plugin_loader()
+
+
+# Add the --save-baseline, --compare and --tolerance options every benchmark script supports.
+def add_baseline_arguments(parser):
+    parser.add_argument('--save-baseline', metavar='NAME', help='save the summary as benchmarks/baselines/NAME.json')
+    parser.add_argument('--compare', metavar='NAME', help='compare the summary with benchmarks/baselines/NAME.json')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative regression when comparing with a baseline (default 0.2)')
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+
+
+# Print the summary, save or compare it as asked for on the command line and return the process exit code.
+def report(args, summary):
+    if args.json:
+        print(json.dumps(summary, indent=2, sort_keys=True))
+    else:
+        for key in sorted(summary):
+            value = summary[key]
+            print('%-24s %s' % (key, ('%.4f' % value) if isinstance(value, float) else value))
+
+    if args.save_baseline:
+        save_baseline(args.save_baseline, summary)
+
+    if args.compare:
+        regressions = compare_baseline(args.compare, summary, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: %s' % regression, file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
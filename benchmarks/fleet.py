@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# Drive my_action_plugin against a simulated fleet of hosts, entirely on the local machine.
+#
+# Every simulated host gets a FakeConnection, a real Ansible connection plugin (ConnectionBase subclass) that never
+# leaves the process: each remote command sleeps for the host's injected latency, fails with the configured
+# probability, and answers the raw probe, the remote tmp dir commands and the setup module with canned output. The
+# action plugin itself runs unmodified, including AnsiballZ payload building, so the numbers include the controller
+# side cost of every code path.
+#
+# Hosts are run through a pool of --forks workers (processes by default, like Ansible's forks). --repeat runs the
+# whole fleet several times in a row, like several tasks of a play using the gate, which shows the effect of the fact
+# cache.
+#
+# Usage:
+#
+#   python benchmarks/fleet.py --hosts 500 --forks 50 --latency 0.05 --jitter 0.02 --failure-rate 0.01
+#   python benchmarks/fleet.py --hosts 500 --probe-mode raw --save-baseline raw-probe
+#   python benchmarks/fleet.py --hosts 500 --probe-mode raw --compare raw-probe
+#   python benchmarks/fleet.py --hosts 200 --repeat 5 --fact-cache-ttl 0 --no-pipelining --persistent-tmp
+#
+# Requires Ansible to be importable by the interpreter running the script.
+
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+
+from ansible.errors import AnsibleConnectionFailure
+from ansible.parsing.dataloader import DataLoader
+from ansible.playbook.play_context import PlayContext
+from ansible.playbook.task import Task
+from ansible.plugins import loader as plugin_loader
+from ansible.plugins.connection import ConnectionBase
+from ansible.template import Templar
+
+import benchlib
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Canned output of the raw probe and of the setup module.
+PROBE_OUTPUT = b'ansible_system=Linux\nansible_kernel=6.1.0\nansible_machine=x86_64\n'
+SETUP_OUTPUT = json.dumps(dict(
+    changed=False,
+    ansible_facts=dict(ansible_system='Linux', ansible_kernel='6.1.0', ansible_machine='x86_64')
+)).encode('utf-8')
+
+# The remote tmp dir is created with `echo <basefile>=<path>`; ActionBase reads the path back from that line.
+MKDTEMP_RE = re.compile(r'echo (ansible-tmp-[^=]+)=')
+
+# The persistent tmp dir (persistent_tmp) is created with `mkdir -p <path> && cd <path> && pwd`, in the same command
+# that removes stale dirs; the plugin reads the path back from the last line.
+PERSISTENT_TMP_RE = re.compile(r'mkdir -p (\S+) && cd \S+ && pwd')
+
+
+# Raised for a remote command FakeConnection has no canned answer for. Rather than feed the plugin made up output,
+# run_host lets it through and the benchmark stops: the simulation needs to learn about the command first.
+class UnexpectedCommand(Exception):
+    pass
+
+
+# Per host latency and failure behaviour. The random generator is seeded per host so runs are repeatable.
+class HostProfile(object):
+    def __init__(self, index, args):
+        self.name = 'host%05d' % index
+        self.rng = random.Random(args.seed * 1000003 + index)
+        self.latency = args.latency
+        self.jitter = args.jitter
+        self.failure_rate = args.failure_rate
+        self.factor = args.slow_factor if self.rng.random() < args.slow_fraction else 1.0
+
+    # Sleep for one simulated round trip.
+    def wait(self):
+        time.sleep(max(0.0, self.rng.gauss(self.latency, self.jitter)) * self.factor)
+
+    def fails(self):
+        return self.rng.random() < self.failure_rate
+
+
+# A connection plugin that simulates a remote host instead of talking to one.
+class FakeConnection(ConnectionBase):
+    transport = 'fake'
+    has_pipelining = True
+
+    def __init__(self, play_context, profile):
+        super(FakeConnection, self).__init__(play_context, None, shell=plugin_loader.shell_loader.get('sh'))
+        self.profile = profile
+
+    # Not loaded through the plugin loader, so it has no options to set.
+    def set_options(self, *args, **kwargs):
+        pass
+
+    def _connect(self):
+        if not self._connected:
+            self.profile.wait()
+            self._connected = True
+        return self
+
+    def exec_command(self, cmd, in_data=None, sudoable=True):
+        self._connect()
+        self.profile.wait()
+        if self.profile.fails():
+            raise AnsibleConnectionFailure('simulated failure talking to %s' % self.profile.name)
+
+        mkdtemp = MKDTEMP_RE.search(cmd)
+        if mkdtemp:
+            return 0, ('%s=/tmp/fake/%s\n' % (mkdtemp.group(1), mkdtemp.group(1))).encode('utf-8'), b''
+        if 'uname -s' in cmd:
+            return 0, PROBE_OUTPUT, b''
+        if 'echo ~' in cmd:
+            return 0, b'/home/fake\n', b''
+        persistent_tmp = PERSISTENT_TMP_RE.search(cmd)
+        if persistent_tmp:
+            return 0, ('%s\n' % persistent_tmp.group(1).replace('~', '/home/fake', 1)).encode('utf-8'), b''
+        if 'rm -f -r' in cmd or 'chmod' in cmd:
+            return 0, b'', b''
+        # The module itself: piped in on stdin with pipelining, run from the uploaded AnsiballZ file without.
+        if in_data is not None or 'AnsiballZ_' in cmd:
+            return 0, SETUP_OUTPUT, b''
+        raise UnexpectedCommand('%s: no canned answer for command %r' % (self.profile.name, cmd))
+
+    def put_file(self, in_path, out_path):
+        self.profile.wait()
+
+    def fetch_file(self, in_path, out_path):
+        self.profile.wait()
+
+    def close(self):
+        self._connected = False
+
+
+# The plugin loaders, except that the connections the plugin opens itself (probes with a deadline run over connections
+# of their own) are more FakeConnections to the same simulated host.
+class FakeLoaders(object):
+    def __init__(self, profile):
+        self.profile = profile
+        self.connection_loader = self
+
+    def get(self, name, play_context, *args, **kwargs):
+        return FakeConnection(play_context, self.profile)
+
+    def __getattr__(self, name):
+        return getattr(plugin_loader, name)
+
+
+def load_action_module():
+    spec = importlib.util.spec_from_file_location('my_action_plugin', os.path.join(REPO_DIR, 'my_action_plugin.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.ActionModule
+
+
+# Set in each worker by init_worker.
+ARGS = None
+ACTION_MODULE = None
+
+
+def init_worker(args):
+    global ARGS, ACTION_MODULE
+    ARGS = args
+    benchlib.init_ansible_plugins()
+    ACTION_MODULE = load_action_module()
+
+
+# Run the action plugin once for one simulated host. Returns (seconds, failed). Any error raised by the plugin counts
+# as a failure of that host, except UnexpectedCommand, which is a problem with the simulation and stops the run.
+def run_host(index):
+    profile = HostProfile(index, ARGS)
+
+    play_context = PlayContext()
+    play_context.remote_addr = profile.name
+    play_context.pipelining = ARGS.pipelining
+
+    task = Task()
+    task.action = 'my_action_plugin'
+    task.args = dict(
+        fact_cache=ARGS.fact_cache,
+        fact_cache_path=ARGS.fact_cache_path,
+        probe_mode=ARGS.probe_mode,
+        persistent_tmp=ARGS.persistent_tmp
+    )
+    if ARGS.fact_cache_ttl is not None:
+        task.args['fact_cache_ttl'] = ARGS.fact_cache_ttl
+
+    task_vars = dict(
+        inventory_hostname=profile.name,
+        ansible_python_interpreter=sys.executable,
+        hostvars=dict()
+    )
+    loader = DataLoader()
+    action = ACTION_MODULE(
+        task=task,
+        connection=FakeConnection(play_context, profile),
+        play_context=play_context,
+        loader=loader,
+        templar=Templar(loader=loader, variables=task_vars),
+        shared_loader_obj=plugin_loader
+    )
+    # Set afterwards: newer ActionBase versions ignore shared_loader_obj and always use the real loaders.
+    action._shared_loader_obj = FakeLoaders(profile)
+
+    start = time.time()
+    try:
+        result = action.run(task_vars=task_vars)
+        failed = bool(result.get('failed'))
+    except UnexpectedCommand:
+        raise
+    except Exception:
+        failed = True
+    return time.time() - start, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark my_action_plugin against a simulated fleet')
+    parser.add_argument('--hosts', type=int, default=100, help='number of simulated hosts')
+    parser.add_argument('--forks', type=int, default=20, help='concurrent workers, like ansible --forks')
+    parser.add_argument('--pool', choices=('process', 'thread'), default='process', help='kind of worker pool')
+    parser.add_argument('--repeat', type=int, default=1, help='run the whole fleet this many times in a row')
+    parser.add_argument('--latency', type=float, default=0.02, help='mean seconds per simulated round trip')
+    parser.add_argument('--jitter', type=float, default=0.005, help='standard deviation of the round trip time')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='probability a remote command fails')
+    parser.add_argument('--slow-fraction', type=float, default=0.0, help='fraction of hosts that are stragglers')
+    parser.add_argument('--slow-factor', type=float, default=10.0, help='latency multiplier for the stragglers')
+    parser.add_argument('--probe-mode', choices=('setup', 'raw'), default='setup')
+    parser.add_argument('--no-fact-cache', dest='fact_cache', action='store_false', help='disable the fact cache')
+    parser.add_argument('--no-pipelining', dest='pipelining', action='store_false',
+                        help='transfer the module with put_file instead of piping it in')
+    parser.add_argument('--fact-cache-ttl', type=int, help='seconds cached facts stay valid (0 runs the probe or '
+                                                              'setup on every repeat)')
+    parser.add_argument('--persistent-tmp', action='store_true',
+                        help='run setup from a persistent remote tmp dir (needs --no-pipelining to make a difference)')
+    parser.add_argument('--seed', type=int, default=0)
+    benchlib.add_baseline_arguments(parser)
+    args = parser.parse_args()
+
+    # Every benchmark run starts from an empty fact cache.
+    cache_dir = tempfile.mkdtemp(prefix='fleet-bench-')
+    args.fact_cache_path = os.path.join(cache_dir, 'facts.sqlite')
+
+    pool_class = multiprocessing.Pool if args.pool == 'process' else ThreadPool
+    pool = pool_class(args.forks, initializer=init_worker, initargs=(args,))
+
+    latencies = []
+    failures = 0
+    start = time.time()
+    try:
+        for _ in range(args.repeat):
+            for seconds, failed in pool.imap_unordered(run_host, range(args.hosts)):
+                latencies.append(seconds)
+                failures += failed
+        elapsed = time.time() - start
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    summary = benchlib.summarize(latencies, elapsed, failures)
+    summary.update(hosts=args.hosts, forks=args.forks, repeat=args.repeat, probe_mode=args.probe_mode,
+                   persistent_tmp=args.persistent_tmp)
+    sys.exit(benchlib.report(args, summary))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# Compare the payload size and import time of my_module against the previous default_collectors import path.
+#
+# Two costs are measured per variant:
+#
+# * The payload: AnsiballZ packs every ansible.module_utils file its static import scan finds into the zip it sends
+#   to the target. The payload is built with Ansible's own module_common.modify_module, exactly as the controller
+#   builds it, and its size and the number of files in its zip are reported.
+# * The imports: the target interpreter only imports what the module actually imports at run time. Each variant is
+#   imported in a fresh interpreter, timing the imports and counting the ansible.module_utils files loaded.
+#
+# Usage:
+#
+#   python benchmarks/module_footprint.py [--runs N] [--json]
+#
+# Requires Ansible to be importable by the interpreter running the script.
+
+import argparse
+import base64
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+import benchlib
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The imports of the default_collectors variant, the import path my_module used before it loaded collectors by name.
+DEFAULT_COLLECTORS_IMPORTS = '''
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.facts.namespace import PrefixFactNamespace
+from ansible.module_utils.facts import ansible_collector, default_collectors
+'''
+
+# Each variant as (name, the code its fresh interpreter runs, the module source AnsiballZ builds the payload from).
+# lean imports the current my_module and loads the collectors it actually resolves.
+VARIANTS = (
+    ('default_collectors', DEFAULT_COLLECTORS_IMPORTS, DEFAULT_COLLECTORS_IMPORTS),
+    ('lean', '''
+import my_module
+my_module.load_collectors(my_module.resolve_gather_subset(my_module.REQUIRED_FACTS))
+''', None),
+)
+
+# Wrapper run in the child interpreter: time the variant code and report the module_utils files that got loaded.
+PROBE = '''
+import json, sys, time
+sys.path.insert(0, %(repo_dir)r)
+start = time.time()
+exec(%(code)r)
+elapsed = time.time() - start
+files = sorted(
+    getattr(module, '__file__', None) for name, module in sys.modules.items()
+    if name.startswith('ansible.module_utils') and getattr(module, '__file__', None)
+)
+print(json.dumps(dict(seconds=elapsed, files=files)))
+'''
+
+
+# Build the AnsiballZ payload of the module in module_path the way the controller does. Returns its size in bytes and
+# the number of files in the zip it carries.
+def build_payload(name, module_path):
+    from ansible.executor.module_common import modify_module
+    from ansible.parsing.dataloader import DataLoader
+    from ansible.template import Templar
+
+    built = modify_module(
+        module_name=name,
+        module_path=module_path,
+        module_args=dict(),
+        templar=Templar(loader=DataLoader()),
+        task_vars=dict(ansible_python_interpreter=sys.executable),
+        module_compression='ZIP_DEFLATED'
+    )
+    # A named result on newer versions, a (data, style, shebang) tuple on older ones.
+    data = getattr(built, 'b_module_data', None) or built[0]
+    # The zip is embedded base64 encoded; it is by far the longest base64 run in the wrapper.
+    encoded = max(re.findall(br'[A-Za-z0-9+/=]{1000,}', data), key=len)
+    with zipfile.ZipFile(io.BytesIO(base64.b64decode(encoded))) as zf:
+        return len(data), len(zf.namelist())
+
+
+def measure(name, code, module_source, runs, work_dir):
+    timings = []
+    files = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', PROBE % dict(repo_dir=REPO_DIR, code=code)])
+        sample = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        timings.append(sample['seconds'])
+        files = sample['files']
+
+    module_path = os.path.join(REPO_DIR, 'my_module.py')
+    if module_source is not None:
+        module_path = os.path.join(work_dir, '%s.py' % name)
+        with open(module_path, 'w') as f:
+            f.write(module_source)
+    payload_bytes, payload_files = build_payload('footprint_%s' % name, module_path)
+
+    timings.sort()
+    return dict(
+        variant=name,
+        modules_loaded=len(files),
+        payload_bytes=payload_bytes,
+        payload_files=payload_files,
+        import_seconds_min=timings[0],
+        import_seconds_median=timings[len(timings) // 2],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare my_module payload size and import time')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters to time per variant')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    benchlib.init_ansible_plugins()
+    work_dir = tempfile.mkdtemp(prefix='module-footprint-')
+    try:
+        results = [measure(name, code, module_source, args.runs, work_dir) for name, code, module_source in VARIANTS]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    baseline = results[0]
+    print('%-20s %8s %14s %14s %12s' % ('variant', 'loaded', 'payload bytes', 'payload files', 'import ms'))
+    for result in results:
+        print('%-20s %8d %14d %14d %12.1f' % (
+            result['variant'], result['modules_loaded'], result['payload_bytes'], result['payload_files'],
+            result['import_seconds_median'] * 1000
+        ))
+    for result in results[1:]:
+        print('%s vs %s: %d fewer module_utils files loaded, payload %.2fx the size, imports %.2fx faster' % (
+            result['variant'], baseline['variant'],
+            baseline['modules_loaded'] - result['modules_loaded'],
+            result['payload_bytes'] / float(max(baseline['payload_bytes'], 1)),
+            baseline['import_seconds_median'] / max(result['import_seconds_median'], 1e-9)
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# Microbenchmark my_module.run_module in process, against the local machine.
+#
+# run_module is called repeatedly with its arguments fed in through ansible.module_utils.basic._ANSIBLE_ARGS, the
+# same hook AnsiballZ uses, and with stdout captured so the JSON it prints can be checked. tracemalloc tracks the
+# peak Python heap allocated during the runs.
+#
+# Usage:
+#
+#   python benchmarks/module_run.py --iterations 200
+#   python benchmarks/module_run.py --parallel --facts 'ansible_distribution*' --save-baseline parallel
+#   python benchmarks/module_run.py --snapshot --compare snapshot
+#
+# Requires Ansible to be importable by the interpreter running the script.
+
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from ansible.module_utils import basic
+
+import benchlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import my_module  # noqa: E402
+
+
+# Run the module once with module_args and return the result it printed.
+def run_once(module_args):
+    basic._ANSIBLE_ARGS = json.dumps(dict(ANSIBLE_MODULE_ARGS=module_args)).encode('utf-8')
+    # ansible-core 2.19 and later also need the serialization profile AnsiballZ would pass along with the arguments.
+    if hasattr(basic, '_ANSIBLE_PROFILE'):
+        basic._ANSIBLE_PROFILE = 'legacy'
+
+    stdout = io.StringIO()
+    saved_stdout = sys.stdout
+    sys.stdout = stdout
+    try:
+        my_module.run_module()
+    except SystemExit:
+        pass
+    finally:
+        sys.stdout = saved_stdout
+
+    return json.loads(stdout.getvalue())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmark my_module.run_module in process')
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--warmup', type=int, default=5, help='untimed runs before measuring')
+    parser.add_argument('--parallel', action='store_true', help='pass parallel=true to the module')
+    parser.add_argument('--facts', action='append', help='fact name or pattern to project (repeatable)')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='use an on-host snapshot (in a temporary directory) instead of always collecting')
+    benchlib.add_baseline_arguments(parser)
+    args = parser.parse_args()
+
+    snapshot_dir = tempfile.mkdtemp(prefix='module-bench-')
+    module_args = dict(
+        name='benchmark',
+        parallel=args.parallel,
+        snapshot_path=os.path.join(snapshot_dir, 'facts.json.gz') if args.snapshot else ''
+    )
+    if args.facts:
+        module_args['facts'] = args.facts
+
+    try:
+        for _ in range(args.warmup):
+            run_once(module_args)
+
+        latencies = []
+        failures = 0
+        tracemalloc.start()
+        start = time.time()
+        for _ in range(args.iterations):
+            run_start = time.time()
+            result = run_once(module_args)
+            latencies.append(time.time() - run_start)
+            failures += bool(result.get('failed'))
+        elapsed = time.time() - start
+        heap_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+    summary = benchlib.summarize(latencies, elapsed, failures)
+    summary.update(
+        iterations=args.iterations,
+        heap_peak_kb=heap_peak // 1024,
+        result_bytes=len(json.dumps(result))
+    )
+    sys.exit(benchlib.report(args, summary))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# Compare the plain JSON module result with the compact output_format=zlib one: bytes on the wire, the time the target
+# spends encoding and the time the controller spends parsing.
+#
+# The result measured is a full fact set, as setup with gather_subset=all returns it: either from running the setup
+# module on the local machine, or read from a file holding the output of a setup run (ansible HOST -m setup >
+# facts.json style, one JSON object). Encoding uses my_module.compact_result, parsing uses
+# my_action_plugin.decode_compact_result, so the numbers are those of the code that actually runs.
+#
+# Usage:
+#
+#   python benchmarks/wire_format.py [--runs N] [--json]
+#   python benchmarks/wire_format.py --facts-file facts.json
+#
+# Requires Ansible to be importable by the interpreter running the script.
+
+import argparse
+import importlib.util
+import io
+import json
+import os
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, REPO_DIR)
+import my_module  # noqa: E402
+
+
+def load_decoder():
+    spec = importlib.util.spec_from_file_location('my_action_plugin', os.path.join(REPO_DIR, 'my_action_plugin.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.decode_compact_result
+
+
+# The result of Ansible's own setup module with gather_subset=all, run in process against the local machine. Its
+# arguments go in through ansible.module_utils.basic._ANSIBLE_ARGS, the hook AnsiballZ uses, and the JSON it prints
+# is the result.
+def collect_local_facts():
+    from ansible.module_utils import basic
+    from ansible.modules import setup
+
+    basic._ANSIBLE_ARGS = json.dumps(dict(ANSIBLE_MODULE_ARGS=dict(gather_subset=['all']))).encode('utf-8')
+    # ansible-core 2.19 and later also need the serialization profile AnsiballZ would pass along with the arguments.
+    if hasattr(basic, '_ANSIBLE_PROFILE'):
+        basic._ANSIBLE_PROFILE = 'legacy'
+
+    stdout = io.StringIO()
+    saved_stdout = sys.stdout
+    sys.stdout = stdout
+    try:
+        setup.main()
+    except SystemExit:
+        pass
+    finally:
+        sys.stdout = saved_stdout
+
+    result = json.loads(stdout.getvalue())
+    if result.get('failed'):
+        raise SystemExit('setup failed: %s' % result.get('msg'))
+    return result
+
+
+def median_seconds(func, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def measure(name, result, encode, decode, runs):
+    wire = encode(result)
+    assert decode(wire) == json.loads(json.dumps(result)), '%s does not round trip' % name
+    return dict(
+        variant=name,
+        wire_bytes=len(wire),
+        encode_seconds=median_seconds(lambda: encode(result), runs),
+        parse_seconds=median_seconds(lambda: decode(wire), runs),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the plain JSON and compact zlib module result formats')
+    parser.add_argument('--runs', type=int, default=50, help='timed encodes and parses per variant')
+    parser.add_argument('--facts-file', help='JSON file holding a setup result to use instead of local facts')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    if args.facts_file:
+        with open(args.facts_file) as f:
+            result = json.load(f)
+    else:
+        result = collect_local_facts()
+
+    decode_compact_result = load_decoder()
+    results = [
+        measure('json', result, json.dumps, json.loads, args.runs),
+        measure('zlib', result,
+                lambda value: json.dumps(my_module.compact_result(value)),
+                lambda wire: decode_compact_result(json.loads(wire)),
+                args.runs),
+    ]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    baseline = results[0]
+    print('%-8s %12s %12s %12s' % ('variant', 'wire bytes', 'encode ms', 'parse ms'))
+    for result in results:
+        print('%-8s %12d %12.3f %12.3f' % (
+            result['variant'], result['wire_bytes'], result['encode_seconds'] * 1000, result['parse_seconds'] * 1000
+        ))
+    for result in results[1:]:
+        print('%s vs %s: %.1fx fewer bytes, parse %.2fx the time' % (
+            result['variant'], baseline['variant'],
+            baseline['wire_bytes'] / float(max(result['wire_bytes'], 1)),
+            result['parse_seconds'] / max(baseline['parse_seconds'], 1e-9)
+        ))
+
+
+if __name__ == '__main__':
+    main()
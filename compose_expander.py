@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# Expand a docker-compose file: resolve extends chains and env files into one flat service config per service, the
+# way `docker-compose config` does, and do it incrementally.
+#
+# Compose files and env files are the nodes of a dependency graph: a service depends on the file that defines it, on
+# its env files and on the service it extends, which can live in another file. Every resolved service is memoised
+# under a content hash of exactly those inputs (its own definition, the hash of the service it extends, and the
+# digests of its env files), so after an edit only the services whose inputs changed, and the services extending
+# them, are merged again. Files whose size and mtime did not change are not even read again.
+#
+# With --cache the parsed files and resolved services are kept between runs in a JSON file, so a CI job or a
+# generator re-expanding hundreds of services after a one line change only pays for the services that change.
+# Services are written out one at a time as they are resolved, so output starts straight away and the whole
+# merged config is never held as a single document.
+#
+# Merge rules follow the Compose file reference for extends:
+#
+# * Single value options (image, command, mem_limit, ...) of the extending service replace the extended ones.
+# * ports, expose, external_links, cap_add and cap_drop are combined, dns, dns_search and env_file are concatenated.
+# * environment and labels are merged by key, volumes and devices by container path.
+# * links, volumes_from and depends_on are never inherited.
+#
+# env_file entries are resolved into environment, with environment taking precedence, and relative paths (env_file,
+# build and host volume paths) are resolved against the directory of the file that declares them. Variables without
+# a value (SESSION_SECRET:) stay empty: Compose resolves them on the machine it runs on.
+#
+# Usage:
+#
+#   python compose_expander.py docker-compose.yml
+#   python compose_expander.py docker-compose.yml --cache .compose-cache.json --stats
+#   python compose_expander.py docker-compose.yml --service web --service worker --format json
+#
+# Requires PyYAML.
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+import yaml
+
+# Use the libyaml based loader when PyYAML was built with it, it parses several times faster.
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# Bump when the format of the cache file or of resolved services changes, so older caches are ignored.
+CACHE_VERSION = 2
+
+# How the options of an extended service combine with the options of the service extending it.
+MERGED_BY_KEY = frozenset(('environment', 'labels', 'build', 'extra_hosts', 'sysctls', 'ulimits'))
+COMBINED = frozenset(('cap_add', 'cap_drop', 'expose', 'external_links', 'ports', 'security_opt'))
+CONCATENATED = frozenset(('dns', 'dns_search', 'env_file', 'tmpfs'))
+MERGED_BY_TARGET = frozenset(('devices', 'volumes'))
+NOT_INHERITED = frozenset(('depends_on', 'links', 'volumes_from'))
+
+
+class ComposeError(Exception):
+    pass
+
+
+def listify(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+# environment and labels may be a list of KEY=VALUE (or bare KEY) strings, or a mapping.
+def mapping(value):
+    if isinstance(value, dict):
+        return dict(value)
+    result = {}
+    for item in listify(value):
+        key, sep, setting = str(item).partition('=')
+        result[key] = setting if sep else None
+    return result
+
+
+# Parse an env file: KEY=VALUE lines, with comments and blank lines ignored. A bare KEY has no value.
+def parse_env_file(text):
+    environment = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        key, sep, value = line.partition('=')
+        environment[key.strip()] = value if sep else None
+    return environment
+
+
+# The container side of a volume or device spec (host:container[:mode]), which is what specs are merged on.
+def volume_target(spec):
+    if isinstance(spec, dict):
+        return spec.get('target')
+    parts = str(spec).split(':')
+    return parts[1] if len(parts) > 1 else parts[0]
+
+
+def resolve_host_path(path, base_dir):
+    if path.startswith('.'):
+        return os.path.normpath(os.path.join(base_dir, path))
+    return path
+
+
+# Bring a service definition, as written in the file at path, into the form services are merged in: mappings for
+# environment and labels, lists for the list-or-string options and paths resolved against the file's directory.
+def normalise_service(service, path):
+    base_dir = os.path.dirname(path)
+    service = dict((key, value) for key, value in service.items() if key != 'extends')
+
+    for key in ('environment', 'labels'):
+        if key in service:
+            service[key] = mapping(service[key])
+    for key in CONCATENATED:
+        if key in service:
+            service[key] = listify(service[key])
+
+    if 'env_file' in service:
+        service['env_file'] = [os.path.normpath(os.path.join(base_dir, env_file)) for env_file in service['env_file']]
+    if 'build' in service:
+        build = service['build'] if isinstance(service['build'], dict) else dict(context=service['build'])
+        if 'context' in build:
+            build = dict(build, context=os.path.normpath(os.path.join(base_dir, build['context'])))
+        service['build'] = build
+    if 'volumes' in service:
+        volumes = []
+        for spec in service['volumes']:
+            parts = str(spec).split(':') if not isinstance(spec, dict) else None
+            if parts and len(parts) > 1:
+                spec = ':'.join([resolve_host_path(parts[0], base_dir)] + parts[1:])
+            volumes.append(spec)
+        service['volumes'] = volumes
+    return service
+
+
+# Merge the service extending another (local) into the resolved service it extends (base).
+def merge_services(base, local):
+    result = dict((key, value) for key, value in base.items() if key not in NOT_INHERITED)
+    for key, value in local.items():
+        if key not in result:
+            result[key] = value
+        elif key in MERGED_BY_KEY and isinstance(result[key], dict) and isinstance(value, dict):
+            merged = dict(result[key])
+            merged.update(value)
+            result[key] = merged
+        elif key in COMBINED:
+            result[key] = listify(result[key]) + [item for item in listify(value) if item not in listify(result[key])]
+        elif key in CONCATENATED:
+            result[key] = listify(result[key]) + listify(value)
+        elif key in MERGED_BY_TARGET:
+            specs = dict((volume_target(spec), spec) for spec in result[key])
+            order = [volume_target(spec) for spec in result[key]]
+            for spec in value:
+                if volume_target(spec) not in specs:
+                    order.append(volume_target(spec))
+                specs[volume_target(spec)] = spec
+            result[key] = [specs[target] for target in order]
+        else:
+            result[key] = value
+    return result
+
+
+class ComposeExpander(object):
+    def __init__(self):
+        # path -> dict(stat, digest, data): data is the services of a compose file or the variables of an env file.
+        self.files = {}
+        # content hash -> dict(merged, final): merged is what extending services build on, final is the flattened
+        # service as emitted, with env files folded into environment.
+        self.resolved = {}
+        self.stats = dict(files_read=0, files_reused=0, services_expanded=0, services_reused=0)
+        self._run = {}
+        self._checked = {}
+        self._used = set()
+
+    def load_cache(self, path):
+        try:
+            with open(path) as f:
+                cache = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if cache.get('version') == CACHE_VERSION:
+            self.files = cache['files']
+            self.resolved = cache['resolved']
+
+    # Save the cache. With prune, resolved services not used since the cache was loaded are dropped.
+    def save_cache(self, path, prune=True):
+        resolved = self.resolved
+        if prune:
+            resolved = dict((key, resolved[key]) for key in self._used if key in resolved)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(version=CACHE_VERSION, files=self.files, resolved=resolved), f, separators=(',', ':'))
+        os.rename(tmp_path, path)
+
+    # The parsed content of a compose file (kind='compose') or env file (kind='env'). A file is only read again
+    # when its size or mtime changed, and only parsed again when its content did. Each file is checked once per run.
+    def _file(self, path, kind):
+        if path in self._checked:
+            return self._checked[path]
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            raise ComposeError('%s: %s' % (path, e.strerror))
+        signature = [stat.st_size, stat.st_mtime]
+
+        entry = self.files.get(path)
+        if entry is not None and entry['stat'] == signature:
+            self.stats['files_reused'] += 1
+            self._checked[path] = entry
+            return entry
+
+        with open(path, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if entry is not None and entry['digest'] == digest:
+            entry['stat'] = signature
+            self.stats['files_reused'] += 1
+            self._checked[path] = entry
+            return entry
+
+        self.stats['files_read'] += 1
+        text = content.decode('utf-8')
+        if kind == 'env':
+            data = parse_env_file(text)
+        else:
+            try:
+                data = yaml.load(text, Loader=SafeLoader) or {}
+            except yaml.YAMLError as e:
+                raise ComposeError('%s: %s' % (path, e))
+            if not isinstance(data, dict):
+                raise ComposeError('%s: expected a mapping of services' % path)
+            # Version 2 and later files keep their services under services, version 1 files at the top level. The
+            # Compose specification made version optional, so a services mapping is enough to tell them apart.
+            if isinstance(data.get('services'), dict):
+                data = data['services']
+
+        entry = dict(stat=signature, digest=digest, data=data)
+        self.files[path] = entry
+        self._checked[path] = entry
+        return entry
+
+    # Resolve service name of the compose file at path. Returns (content hash, dict(merged, final)).
+    def resolve(self, path, name, stack=()):
+        ident = (path, name)
+        if ident in stack:
+            chain = ' -> '.join('%s:%s' % item for item in stack[stack.index(ident):] + (ident,))
+            raise ComposeError('extends cycle: %s' % chain)
+        if ident in self._run:
+            return self._run[ident]
+
+        services = self._file(path, 'compose')['data']
+        if name not in services:
+            raise ComposeError('%s: no service %s' % (path, name))
+        raw = services[name] or {}
+        if not isinstance(raw, dict):
+            raise ComposeError('%s: service %s must be a mapping' % (path, name))
+
+        # The service extended, in the same file unless extends names another one.
+        base_key = base = None
+        extends = raw.get('extends')
+        if extends is not None:
+            if isinstance(extends, dict):
+                base_path = path
+                if 'file' in extends:
+                    base_path = os.path.normpath(os.path.join(os.path.dirname(path), extends['file']))
+                base_name = extends.get('service')
+            else:
+                base_path, base_name = path, extends
+            if not base_name:
+                raise ComposeError('%s: service %s extends without a service' % (path, name))
+            base_key, base = self.resolve(base_path, base_name, stack + (ident,))
+
+        local = normalise_service(raw, path)
+        digest = hashlib.sha256()
+        digest.update(json.dumps([path, name, raw, base_key], sort_keys=True, default=str).encode('utf-8'))
+
+        # Env files are hashed by content through the merged env_file list, which includes the extended ones.
+        env_files = listify(base['merged'].get('env_file') if base else None) + local.get('env_file', [])
+        env = [self._file(env_file, 'env') for env_file in env_files]
+        for entry in env:
+            digest.update(entry['digest'].encode('utf-8'))
+        key = digest.hexdigest()
+
+        if key in self.resolved:
+            self.stats['services_reused'] += 1
+        else:
+            self.stats['services_expanded'] += 1
+            merged = merge_services(base['merged'], local) if base else local
+            final = dict((option, value) for option, value in merged.items() if option != 'env_file')
+            if env:
+                environment = {}
+                for entry in env:
+                    environment.update(entry['data'])
+                environment.update(merged.get('environment', {}))
+                final['environment'] = environment
+            self.resolved[key] = dict(merged=merged, final=final)
+
+        self._used.add(key)
+        self._run[ident] = (key, self.resolved[key])
+        return self._run[ident]
+
+    # Yield (name, service) for the services of the compose file at path (or just names), in file order, resolving
+    # each one as it is reached.
+    def expand(self, path, names=None):
+        path = os.path.abspath(path)
+        self._run = {}
+        self._checked = {}
+        services = self._file(path, 'compose')['data']
+        for name in names or list(services):
+            yield name, self.resolve(path, name)[1]['final']
+
+
+# Write the services yielded by expand to out one at a time, as a YAML mapping or a JSON object.
+def emit(services, out, output_format):
+    if output_format == 'json':
+        out.write('{')
+        for index, (name, service) in enumerate(services):
+            out.write('%s\n  %s: %s' % (',' if index else '', json.dumps(name), json.dumps(service, sort_keys=True)))
+            out.flush()
+        out.write('\n}\n')
+        return
+
+    for name, service in services:
+        out.write(yaml.safe_dump({name: service}, default_flow_style=False))
+        out.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Resolve extends and env files of a docker-compose file')
+    parser.add_argument('compose_file', nargs='?', default='docker-compose.yml')
+    parser.add_argument('--service', action='append', help='only expand this service (repeatable)')
+    parser.add_argument('--cache', metavar='FILE', help='keep parsed files and resolved services in FILE between runs')
+    parser.add_argument('--format', choices=('yaml', 'json'), default='yaml')
+    parser.add_argument('--stats', action='store_true', help='print file and service reuse counts to stderr')
+    args = parser.parse_args()
+
+    expander = ComposeExpander()
+    if args.cache:
+        expander.load_cache(args.cache)
+
+    try:
+        emit(expander.expand(args.compose_file, args.service), sys.stdout, args.format)
+    except ComposeError as e:
+        print('error: %s' % e, file=sys.stderr)
+        sys.exit(1)
+
+    if args.cache:
+        # Expanding only some services must not drop what the cache holds for the others.
+        expander.save_cache(args.cache, prune=not args.service)
+    if args.stats:
+        print(' '.join('%s=%d' % item for item in sorted(expander.stats.items())), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
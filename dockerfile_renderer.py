@@ -0,0 +1,637 @@
+#!/usr/bin/env python
+# Render the Dockerfile template, plan its layer cache and optimise it for cache hits, without running Docker.
+#
+# The renderer parses a Dockerfile the way the builder does (parser directives, the escape character, line
+# continuations and comments inside them), fills in ARG and ENV variables, and computes a cache key for every
+# instruction:
+#
+# * Every key chains on the key of the instruction before it, like a layer on its parent.
+# * RUN also depends on the build arguments in scope, which the builder passes to it as environment.
+# * ADD and COPY depend on a digest of the files they copy from the build context (honouring .dockerignore), or on
+#   the final key of the stage they copy from with --from.
+#
+# From those keys it reports which layers would rebuild, either for a list of changed source files (--changed) or
+# against the plan of an earlier build (--previous, saved with --save-plan), so CI can tell in advance whether an
+# expensive build can be skipped.
+#
+# --optimize also rewrites the Dockerfile for better cache reuse:
+#
+# * ADD of local files that are not archives becomes COPY, which has no implicit download or extraction.
+# * Metadata-only instructions (LABEL, EXPOSE, CMD, ...) sink past the RUN, COPY, ADD, WORKDIR, USER and VOLUME
+#   instructions after them, towards the end of their stage, so editing one (a version LABEL, say) no longer
+#   invalidates the expensive layers behind it.
+# * A COPY or ADD with several sources is split so the sources matching --volatile come last, in their own layer.
+#
+# Usage:
+#
+#   python dockerfile_renderer.py Dockerfile --context . --build-arg myvar=1
+#   python dockerfile_renderer.py Dockerfile --changed src/file.cpp --exit-code
+#   python dockerfile_renderer.py Dockerfile --save-plan plan.json
+#   python dockerfile_renderer.py Dockerfile --previous plan.json --json
+#   python dockerfile_renderer.py Dockerfile --optimize --volatile 'src/*' --output Dockerfile.optimized
+#
+# BuildKit only syntax (heredocs, RUN --mount) is passed through as plain instruction text.
+
+import argparse
+import fnmatch
+import glob
+import hashlib
+import json
+import os
+import re
+import shlex
+import sys
+
+# Parser directives are only recognised at the very top of the file, before any comment, blank line or instruction.
+DIRECTIVE_RE = re.compile(r'^#\s*([a-zA-Z][a-zA-Z0-9]*)\s*=\s*(\S+)\s*$')
+
+# $name, ${name}, ${name:-default} and ${name:+alternative}.
+VARIABLE_RE = re.compile(r'\$(?:\{([A-Za-z_][A-Za-z0-9_]*)(?:(:[-+])([^}]*))?\}|([A-Za-z_][A-Za-z0-9_]*))')
+
+# Instructions whose arguments the builder expands variables in.
+SUBSTITUTED = frozenset((
+    'ADD', 'ARG', 'COPY', 'ENV', 'EXPOSE', 'FROM', 'LABEL', 'STOPSIGNAL', 'USER', 'VOLUME', 'WORKDIR'
+))
+
+# Instructions that only change the image configuration, and whose position among RUN, COPY and ADD makes no
+# difference to the image. VOLUME is not one of them: changes to a volume made after it is declared are discarded.
+METADATA = frozenset((
+    'CMD', 'ENTRYPOINT', 'EXPOSE', 'HEALTHCHECK', 'LABEL', 'MAINTAINER', 'ONBUILD', 'STOPSIGNAL'
+))
+
+# Instructions that metadata instructions may be moved past. The rest (FROM, ARG, ENV and SHELL) change how a
+# metadata instruction after them is read, through its variables or the shell its shell form is wrapped in.
+PASSABLE = frozenset(('ADD', 'COPY', 'RUN', 'USER', 'VOLUME', 'WORKDIR'))
+
+# Leading bytes (at the given offset) of the archive formats ADD extracts.
+ARCHIVE_MAGIC = (
+    (0, b'\x1f\x8b'),                  # gzip
+    (0, b'BZh'),                       # bzip2
+    (0, b'\xfd7zXZ\x00'),              # xz
+    (257, b'ustar'),                   # tar
+)
+
+
+class DockerfileError(Exception):
+    pass
+
+
+# One instruction, with its continuation lines joined. line is the line number it starts on.
+class Instruction(object):
+    def __init__(self, keyword, args, line):
+        self.keyword = keyword.upper()
+        self.args = args
+        self.line = line
+
+    def text(self):
+        return ('%s %s' % (self.keyword, self.args)).strip()
+
+
+# Parse Dockerfile text into (escape character, list of Instruction).
+def parse_dockerfile(text):
+    lines = text.splitlines()
+
+    directives = {}
+    index = 0
+    while index < len(lines):
+        match = DIRECTIVE_RE.match(lines[index])
+        if not match or match.group(1).lower() in directives:
+            break
+        directives[match.group(1).lower()] = match.group(2)
+        index += 1
+
+    escape = directives.get('escape', '\\')
+    if escape not in ('\\', '`'):
+        raise DockerfileError('invalid escape directive %r, must be \\ or `' % escape)
+
+    instructions = []
+    pending = None
+    start = None
+    for number in range(index, len(lines)):
+        line = lines[number]
+        stripped = line.strip()
+        # Comments and blank lines are skipped, including in the middle of a continued instruction.
+        if not stripped or stripped.startswith('#'):
+            continue
+
+        if pending is None:
+            pending = []
+            start = number + 1
+        body = line.rstrip()
+        if body.endswith(escape):
+            pending.append(body[:-1])
+            continue
+
+        pending.append(body)
+        instructions.append(split_instruction(''.join(pending), start))
+        pending = None
+
+    if pending:
+        instructions.append(split_instruction(''.join(pending), start))
+    return escape, instructions
+
+
+def split_instruction(text, line):
+    parts = text.strip().split(None, 1)
+    return Instruction(parts[0], parts[1].strip() if len(parts) > 1 else '', line)
+
+
+# Expand variables in value. An escaped $ stays a literal $.
+def substitute(value, variables, escape='\\'):
+    output = []
+    index = 0
+    while index < len(value):
+        char = value[index]
+        if char == escape and value[index + 1:index + 2] == '$':
+            output.append('$')
+            index += 2
+            continue
+
+        match = VARIABLE_RE.match(value, index) if char == '$' else None
+        if match is None:
+            output.append(char)
+            index += 1
+            continue
+
+        current = variables.get(match.group(1) or match.group(4))
+        if match.group(2) == ':-':
+            output.append(current if current else substitute(match.group(3), variables, escape))
+        elif match.group(2) == ':+':
+            output.append(substitute(match.group(3), variables, escape) if current else '')
+        else:
+            output.append(current or '')
+        index = match.end()
+    return ''.join(output)
+
+
+# Split the arguments of ENV or LABEL into (key, value) pairs. Both accept key=value pairs; ENV also has the legacy
+# "ENV key value" form where everything after the key is the value.
+def parse_pairs(args, allow_legacy):
+    words = shlex.split(args)
+    if allow_legacy and words and '=' not in words[0]:
+        key, _, value = args.partition(' ')
+        return [(key, ' '.join(shlex.split(value)))]
+    pairs = []
+    for word in words:
+        key, sep, value = word.partition('=')
+        if not sep:
+            raise DockerfileError('expected key=value, got %r' % word)
+        pairs.append((key, value))
+    return pairs
+
+
+# Split the arguments of ADD or COPY into (flags, sources, destination). Both the JSON and the plain form are
+# accepted.
+def parse_copy(args):
+    words = args.split()
+    flags = []
+    while words and words[0].startswith('--'):
+        flags.append(words.pop(0))
+
+    rest = ' '.join(words)
+    if rest.startswith('['):
+        try:
+            paths = json.loads(rest)
+        except ValueError:
+            paths = shlex.split(rest)
+    else:
+        paths = shlex.split(rest)
+    if len(paths) < 2:
+        raise DockerfileError('%r needs at least one source and a destination' % args)
+    return flags, paths[:-1], paths[-1]
+
+
+def format_copy(keyword, flags, sources, destination):
+    paths = list(sources) + [destination]
+    if any(' ' in path for path in paths):
+        body = json.dumps(paths)
+    else:
+        body = ' '.join(paths)
+    return Instruction(keyword, ' '.join(list(flags) + [body]), None)
+
+
+def flag_value(flags, name):
+    for flag in flags:
+        if flag.startswith('--%s=' % name):
+            return flag.split('=', 1)[1]
+    return None
+
+
+def is_url(source):
+    return re.match(r'^[a-z][a-z0-9+.-]*://', source) is not None
+
+
+def normalise(path):
+    path = os.path.normpath(path.replace('\\', '/')).lstrip('/')
+    return '' if path == '.' else path
+
+
+# Read the .dockerignore patterns of a build context, as a list of (pattern, exclude) tuples.
+def read_dockerignore(context):
+    patterns = []
+    try:
+        with open(os.path.join(context, '.dockerignore')) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                exclude = not line.startswith('!')
+                patterns.append((normalise(line.lstrip('!')), exclude))
+    except (IOError, OSError):
+        pass
+    return patterns
+
+
+# Whether path is excluded by .dockerignore. The last matching pattern wins, and a pattern matching a parent
+# directory applies to everything inside it.
+def is_ignored(path, patterns):
+    ignored = False
+    parents = [path]
+    while '/' in parents[-1]:
+        parents.append(parents[-1].rsplit('/', 1)[0])
+    for pattern, exclude in patterns:
+        if any(fnmatch.fnmatchcase(candidate, pattern) for candidate in parents):
+            ignored = exclude
+    return ignored
+
+
+# Digests of the files in a build context. File digests are memoised by path, size and mtime so a file copied by
+# several instructions is only read once.
+class ContextHasher(object):
+    def __init__(self, context):
+        self.context = os.path.abspath(context)
+        self.ignore = read_dockerignore(self.context)
+        self.file_digests = {}
+
+    # The context files a source pattern refers to, relative to the context and sorted.
+    def expand(self, source):
+        files = set()
+        for match in glob.glob(os.path.join(self.context, normalise(source))):
+            if os.path.isdir(match):
+                for root, dirs, names in os.walk(match):
+                    files.update(os.path.join(root, name) for name in names)
+            else:
+                files.add(match)
+
+        relative = (os.path.relpath(path, self.context).replace(os.sep, '/') for path in files)
+        return sorted(path for path in relative if not is_ignored(path, self.ignore))
+
+    def file_digest(self, path):
+        full_path = os.path.join(self.context, path)
+        stat = os.stat(full_path)
+        memo_key = (path, stat.st_size, stat.st_mtime)
+        if memo_key not in self.file_digests:
+            digest = hashlib.sha256()
+            with open(full_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            self.file_digests[memo_key] = digest.hexdigest()
+        return self.file_digests[memo_key], stat.st_mode & 0o111
+
+    # The digest of everything sources copy: every file's path, executable bits and content. Returns (digest, files).
+    def digest(self, sources):
+        digest = hashlib.sha256()
+        files = []
+        for source in sources:
+            digest.update(('source %s\n' % source).encode('utf-8'))
+            for path in self.expand(source):
+                content, mode = self.file_digest(path)
+                digest.update(('%s %o %s\n' % (path, mode, content)).encode('utf-8'))
+                files.append(path)
+        return digest.hexdigest(), files
+
+    # Whether a changed (possibly deleted or new) context path falls under one of sources.
+    def covers(self, sources, path):
+        path = normalise(path)
+        if is_ignored(path, self.ignore):
+            return False
+        for source in sources:
+            source = normalise(source)
+            if not source or path == source or path.startswith(source + '/'):
+                return True
+            parents = [path]
+            while '/' in parents[-1]:
+                parents.append(parents[-1].rsplit('/', 1)[0])
+            if any(fnmatch.fnmatchcase(candidate, source) for candidate in parents):
+                return True
+        return False
+
+
+# Whether a local file is an archive ADD would extract.
+def is_archive(path):
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(262)
+    except (IOError, OSError):
+        return True
+    return any(head[offset:offset + len(magic)] == magic for offset, magic in ARCHIVE_MAGIC)
+
+
+# One instruction of the plan, with its variables filled in.
+class Step(object):
+    def __init__(self, stage, instruction, rendered):
+        self.stage = stage
+        self.instruction = instruction
+        self.rendered = rendered
+        self.key = None
+        self.sources = []
+        self.files = []
+        self.from_stage = None
+        self.remote = False
+        self.status = 'cached'
+        self.reason = None
+
+    def as_dict(self):
+        return dict(
+            stage=self.stage,
+            line=self.instruction.line,
+            instruction=self.rendered.text(),
+            key=self.key,
+            files=len(self.files),
+            status=self.status,
+            reason=self.reason
+        )
+
+
+# Fill in variables and compute the cache key of every instruction. Returns (steps, stage final keys).
+def plan(instructions, escape, hasher, build_args):
+    steps = []
+    stage_keys = {}
+    global_args = {}
+    stage = None
+    parent = None
+    env = {}
+    args = {}
+
+    for instruction in instructions:
+        keyword = instruction.keyword
+        variables = dict(args, **env) if stage is not None else dict(global_args)
+        text = substitute(instruction.args, variables, escape) if keyword in SUBSTITUTED else instruction.args
+        step = Step(stage, instruction, Instruction(keyword, text, instruction.line))
+        inputs = ''
+
+        if keyword == 'FROM':
+            words = text.split()
+            image = [word for word in words if not word.startswith('--')][0]
+            name = words[-1] if len(words) >= 3 and words[-2].upper() == 'AS' else None
+            if stage is not None:
+                stage_keys[stage] = parent
+            stage = name or str(len(stage_keys))
+            parent = stage_keys.get(image) or hashlib.sha256(('image %s' % image).encode('utf-8')).hexdigest()
+            env = {}
+            args = {}
+            step.stage = stage
+
+        elif keyword == 'ARG':
+            name, sep, default = text.partition('=')
+            if name in build_args:
+                value = build_args[name]
+            elif sep:
+                value = default
+            else:
+                value = global_args.get(name, '')
+            if stage is None:
+                global_args[name] = value
+            else:
+                args[name] = value
+            # Render the value in effect so the output Dockerfile is self contained.
+            step.rendered = Instruction('ARG', '%s=%s' % (name, value) if (sep or name in build_args) else name,
+                                        instruction.line)
+
+        elif keyword == 'ENV':
+            env.update(parse_pairs(text, allow_legacy=True))
+
+        elif keyword in ('ADD', 'COPY'):
+            flags, sources, destination = parse_copy(text)
+            step.sources = sources
+            step.from_stage = flag_value(flags, 'from')
+            if step.from_stage is not None:
+                inputs = stage_keys.get(step.from_stage) or 'image %s' % step.from_stage
+            elif keyword == 'ADD' and any(is_url(source) for source in sources):
+                # Remote sources can only be checked by downloading them, so they always count as changed.
+                step.remote = True
+                inputs = 'remote'
+            else:
+                inputs, step.files = hasher.digest(sources)
+
+        elif keyword == 'RUN':
+            # Build arguments are in the environment of RUN, so their values are part of its cache key.
+            inputs = ' '.join('%s=%s' % item for item in sorted(args.items()))
+
+        if stage is None and keyword not in ('ARG', 'FROM'):
+            raise DockerfileError('line %d: %s before the first FROM' % (instruction.line, keyword))
+
+        if keyword != 'ARG' or stage is not None:
+            digest = hashlib.sha256()
+            digest.update(('%s\n%s\n%s' % (parent, step.rendered.text(), inputs)).encode('utf-8'))
+            step.key = parent = digest.hexdigest()
+        steps.append(step)
+
+    if stage is not None:
+        stage_keys[stage] = parent
+    return steps, stage_keys
+
+
+# Mark the steps that would rebuild when the context paths in changed changed. A step rebuilds when its own inputs
+# changed, when the step before it in the same stage rebuilt, or when a stage it copies from or builds on rebuilt.
+def mark_changed(steps, hasher, changed):
+    rebuilt_stages = set()
+    stage_rebuilding = {}
+    for step in steps:
+        if step.instruction.keyword == 'FROM':
+            image = [word for word in step.rendered.args.split() if not word.startswith('--')][0]
+            if image in rebuilt_stages:
+                step.status, step.reason = 'rebuild', 'base stage %s rebuilt' % image
+        elif step.stage is None:
+            continue
+        elif stage_rebuilding.get(step.stage):
+            step.status, step.reason = 'rebuild', 'parent layer rebuilt'
+        elif step.remote:
+            step.status, step.reason = 'rebuild', 'remote source is always checked'
+        elif step.from_stage is not None and step.from_stage in rebuilt_stages:
+            step.status, step.reason = 'rebuild', 'stage %s rebuilt' % step.from_stage
+        elif step.sources and step.from_stage is None:
+            hits = [path for path in changed if hasher.covers(step.sources, path)]
+            if hits:
+                step.status, step.reason = 'rebuild', 'inputs changed: %s' % ', '.join(sorted(hits))
+
+        if step.status == 'rebuild':
+            stage_rebuilding[step.stage] = True
+            rebuilt_stages.add(step.stage)
+
+
+# Mark the steps whose cache key is not in an earlier plan: the builder has no layer for them.
+def mark_previous(steps, previous):
+    known = set(step['key'] for step in previous['steps'] if step.get('key'))
+    for step in steps:
+        if step.key is not None and step.key not in known:
+            step.status, step.reason = 'rebuild', 'cache key not in previous plan'
+
+
+# Rewrite instructions for better cache reuse. Returns (instructions, list of human readable changes).
+def optimize(instructions, escape, hasher, volatile, build_args):
+    changes = []
+
+    # Variables are needed to find the files behind ADD sources and volatile matches, so work from a plan.
+    steps, _ = plan(instructions, escape, hasher, build_args)
+
+    rewritten = []
+    for step in steps:
+        instruction = step.instruction
+        keyword = instruction.keyword
+        if keyword not in ('ADD', 'COPY') or step.from_stage is not None or step.remote:
+            rewritten.append(instruction)
+            continue
+
+        flags, sources, destination = parse_copy(instruction.args)
+        new_keyword = keyword
+        add_only = [flag for flag in flags if flag.split('=', 1)[0] in ('--checksum', '--keep-git-dir')]
+        if keyword == 'ADD' and not add_only and step.files and \
+                not any(is_archive(os.path.join(hasher.context, path)) for path in step.files):
+            new_keyword = 'COPY'
+            changes.append('line %d: ADD of plain files replaced with COPY' % instruction.line)
+
+        rendered_sources = parse_copy(step.rendered.args)[1]
+        stable = [source for source, rendered in zip(sources, rendered_sources)
+                  if not any(fnmatch.fnmatchcase(normalise(rendered), pattern) for pattern in volatile)]
+        moving = [source for source in sources if source not in stable]
+        if len(sources) > 1 and stable and moving:
+            changes.append('line %d: split into a COPY of %s and a later one of %s'
+                           % (instruction.line, ' '.join(stable), ' '.join(moving)))
+            for part in (stable, moving):
+                split = format_copy(new_keyword, flags, part, destination)
+                split.line = instruction.line
+                rewritten.append(split)
+        elif new_keyword != keyword:
+            replaced = Instruction(new_keyword, instruction.args, instruction.line)
+            rewritten.append(replaced)
+        else:
+            rewritten.append(instruction)
+
+    # Move metadata instructions past the PASSABLE instructions after them, keeping their order among themselves.
+    # Each one is held back, with the keywords it has passed so far, until an instruction it may not pass or the end
+    # of the file.
+    sunk = []
+    held = []
+
+    def release():
+        for instruction, passed in held:
+            if passed:
+                changes.append('line %d: %s moved after %s'
+                               % (instruction.line, instruction.keyword, ', '.join(passed)))
+            sunk.append(instruction)
+        del held[:]
+
+    for instruction in rewritten:
+        keyword = instruction.keyword
+        if keyword in METADATA:
+            held.append((instruction, []))
+        elif keyword in PASSABLE:
+            for _, passed in held:
+                passed.append(keyword)
+            sunk.append(instruction)
+        else:
+            release()
+            sunk.append(instruction)
+    release()
+
+    return sunk, changes
+
+
+def render(escape, instructions):
+    lines = []
+    if escape != '\\':
+        lines.append('# escape=%s' % escape)
+    lines.extend(instruction.text() for instruction in instructions)
+    return '\n'.join(lines) + '\n'
+
+
+def parse_assignments(values, option):
+    result = {}
+    for value in values or []:
+        name, sep, setting = value.partition('=')
+        if not sep:
+            # Like docker build, --build-arg NAME takes the value from the environment.
+            if name not in os.environ:
+                continue
+            setting = os.environ[name]
+        if not name:
+            raise DockerfileError('%s expects NAME=VALUE, got %r' % (option, value))
+        result[name] = setting
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render a Dockerfile and plan its layer cache')
+    parser.add_argument('dockerfile', nargs='?', default='Dockerfile')
+    parser.add_argument('--context', default='.', help='build context directory (default: current directory)')
+    parser.add_argument('--build-arg', action='append', metavar='NAME=VALUE', help='set a build argument')
+    parser.add_argument('--changed', action='append', default=[], metavar='PATH',
+                        help='context path that changed since the last build (repeatable)')
+    parser.add_argument('--previous', metavar='PLAN', help='plan of the last build, saved with --save-plan')
+    parser.add_argument('--save-plan', metavar='PLAN', help='save the plan as JSON')
+    parser.add_argument('--optimize', action='store_true', help='rewrite the Dockerfile for better cache reuse')
+    parser.add_argument('--volatile', action='append', default=[], metavar='GLOB',
+                        help='context paths that change often, copied last by --optimize (repeatable)')
+    parser.add_argument('--output', metavar='FILE', help='write the rendered Dockerfile to FILE')
+    parser.add_argument('--json', action='store_true', help='print the plan as JSON')
+    parser.add_argument('--exit-code', action='store_true', help='exit with 1 when any layer would rebuild')
+    args = parser.parse_args()
+
+    try:
+        with open(args.dockerfile) as f:
+            escape, instructions = parse_dockerfile(f.read())
+
+        build_args = parse_assignments(args.build_arg, '--build-arg')
+        hasher = ContextHasher(args.context)
+        changes = []
+        if args.optimize:
+            instructions, changes = optimize(instructions, escape, hasher, args.volatile, build_args)
+
+        steps, stage_keys = plan(instructions, escape, hasher, build_args)
+        if args.changed:
+            mark_changed(steps, hasher, args.changed)
+        if args.previous:
+            with open(args.previous) as f:
+                mark_previous(steps, json.load(f))
+    except (DockerfileError, IOError, OSError, ValueError) as e:
+        print('error: %s' % e, file=sys.stderr)
+        sys.exit(2)
+
+    rebuild = [step for step in steps if step.status == 'rebuild']
+    summary = dict(
+        steps=[step.as_dict() for step in steps],
+        stages=stage_keys,
+        rebuild=len(rebuild),
+        rebuild_from=rebuild[0].as_dict() if rebuild else None,
+        changes=changes
+    )
+
+    if args.save_plan:
+        with open(args.save_plan, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(render(escape, [step.rendered for step in steps]))
+
+    if args.json:
+        print(json.dumps(summary, indent=2, sort_keys=True))
+    else:
+        for change in changes:
+            print('optimized: %s' % change)
+        for step in steps:
+            print('%-8s %-12s %-8s %s' % (
+                step.status, (step.key or '')[:12], step.stage or '-', step.rendered.text()[:90]
+            ))
+            if step.reason and step.status == 'rebuild' and step.reason != 'parent layer rebuilt':
+                print('%32s%s' % ('', step.reason))
+        print('%d of %d layers would rebuild' % (len(rebuild), len([step for step in steps if step.key])))
+
+    if args.exit_code and rebuild:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,14 +4,37 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+# Standard library helpers for the controller side fact cache
+import base64
+import errno
+import hashlib
+import json
+import math
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
 # Important contants
 from ansible import constants as C
 # Common error handlers
 from ansible.errors import AnsibleError
+# Convert command output to text on both Python 2 and 3
+from ansible.module_utils._text import to_bytes, to_text
 # Use Ansible's builtin boolean type if needed
 from ansible.module_utils.parsing.convert_bool import boolean
+# Python 2/3 compatible shell quoting and queue for the fleet wide probe
+from ansible.module_utils.six.moves import queue, shlex_quote
+# The fact collectors the setup module can run, used to work out the smallest gather_subset for a task
+from ansible.module_utils.facts import default_collectors
 # ADT base class for our Ansible Action Plugin
 from ansible.plugins.action import ActionBase
+# Templates the connection vars of other hosts probed with gate_mode=fleet
+from ansible.template import Templar
 
 # Load the display hander to send logging to CLI or relevant display mechanism
 try:
@@ -20,6 +43,305 @@ except ImportError:
     from ansible.utils.display import Display
     display = Display()
 
+
+# Nearest rank percentile of an already sorted list.
+def percentile(sorted_values, pct):
+    rank = int(math.ceil(pct / 100.0 * len(sorted_values))) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+# Base64 characters decoded per step by decode_compact_result. A multiple of 4, so every chunk decodes on its own.
+COMPACT_CHUNK = 64 * 1024
+
+
+# Unpack a module result returned with output_format=zlib (see my_module) back into a plain result dict. Results
+# without compact_result, or in a format this plugin does not know, are returned unchanged.
+#
+# This is not streaming: the base64 text is already in memory as part of the parsed result, and the inflated chunks
+# are joined before json.loads. Decoding and inflating one chunk at a time only saves holding a full binary copy of
+# the compressed bytes as well.
+def decode_compact_result(data):
+    compact = data.get('compact_result')
+    if not isinstance(compact, dict) or compact.get('format') != 'zlib':
+        return data
+
+    encoded = compact['data']
+    inflater = zlib.decompressobj()
+    chunks = []
+    for start in range(0, len(encoded), COMPACT_CHUNK):
+        chunks.append(inflater.decompress(base64.b64decode(encoded[start:start + COMPACT_CHUNK])))
+    chunks.append(inflater.flush())
+
+    result = dict((key, value) for key, value in data.items() if key != 'compact_result')
+    result.update(json.loads(b''.join(chunks).decode('utf-8')))
+    return result
+
+
+# Opt-in profiling of a plugin run (profile task argument or MY_ACTION_PLUGIN_PROFILE). cProfile, pstats and
+# tracemalloc are only imported once a run asks for a profile.
+#
+# cProfile only sees the thread it was enabled on, so time spent on the probe threads of hedge and gate_mode=fleet
+# shows up as the waits for them rather than as the probes themselves.
+#
+# Returns (profiler, started_tracing). tracemalloc may already be tracing when the run starts, e.g. under
+# PYTHONTRACEMALLOC; it is then left running, and the memory reported includes what was traced before the run.
+def start_profile():
+    import cProfile
+    import pstats  # noqa: F401, imported before tracemalloc starts so it is not counted
+    started_tracing = False
+    try:
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracing = True
+    except ImportError:
+        # Python 2 controllers only get the function timings.
+        pass
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler, started_tracing
+
+
+# Strip a controller source path down to the package relative part, e.g. ansible/plugins/action/__init__.py.
+def short_path(path):
+    index = path.rfind('/ansible/')
+    if index != -1:
+        return path[index + 1:]
+    return os.path.basename(path)
+
+
+# Stop the profile start_profile returned and return the top functions by own time as [function, calls, own
+# seconds, cumulative seconds], and the traced memory with its top allocating lines as [line, bytes, blocks].
+# tracemalloc is only stopped if start_profile started it.
+def stop_profile(profile, top):
+    import pstats
+    profiler, started_tracing = profile
+    profiler.disable()
+
+    stats = pstats.Stats(profiler).stats
+    hottest = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:top]
+    report = dict(functions=[
+        ['%s:%d(%s)' % (short_path(path), line, name), calls, round(own, 6), round(cumulative, 6)]
+        for (path, line, name), (primitive_calls, calls, own, cumulative, callers) in hottest
+    ])
+
+    tracemalloc = sys.modules.get('tracemalloc')
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, module.__file__) for module in (tracemalloc, pstats, sys.modules['cProfile'])
+        ])
+        if started_tracing:
+            tracemalloc.stop()
+        report['memory'] = dict(
+            current_bytes=current,
+            peak_bytes=peak,
+            top=[
+                ['%s:%d' % (short_path(stat.traceback[0].filename), stat.traceback[0].lineno), stat.size, stat.count]
+                for stat in snapshot.statistics('lineno')[:top]
+            ]
+        )
+    return report
+
+
+# Controller side cache of host facts.
+#
+# Every task invocation runs in its own forked worker process, so anything kept in memory on the ActionModule
+# instance is thrown away as soon as the task finishes. To share facts between forks (and between plays) we keep
+# them in a small SQLite database on the controller. SQLite handles the locking between processes for us; we only
+# have to make sure that every process uses its own connection. A connection is opened (and the schema created) the
+# first time a process uses the database and then kept for the rest of the process, keyed by pid so a forked worker
+# never reuses its parent's. The threads of hedge and gate_mode=fleet share it under a lock.
+#
+# Facts are stored one row per (host, fact key) so that a task only needs the keys it actually reads to be fresh.
+# Hit and miss counters are kept per play in the same database so they add up across the forks of a play, as is a
+# rolling history of how long each host took to answer, which the adaptive timeouts are derived from, and the
+# persistent remote tmp dirs (with the digest of every file uploaded to them) used by persistent_tmp.
+class FactCache(object):
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS facts (host TEXT, key TEXT, value TEXT, stored REAL, PRIMARY KEY (host, key))',
+        'CREATE TABLE IF NOT EXISTS play_stats (play TEXT, name TEXT, value INTEGER, stored REAL, '
+        'PRIMARY KEY (play, name))',
+        'CREATE TABLE IF NOT EXISTS latency (host TEXT, kind TEXT, stored REAL, seconds REAL)',
+        'CREATE INDEX IF NOT EXISTS latency_host ON latency (host, kind, stored)',
+        'CREATE TABLE IF NOT EXISTS gate_claims (play TEXT PRIMARY KEY, claimed REAL)',
+        'CREATE TABLE IF NOT EXISTS gate (play TEXT, host TEXT, facts TEXT, stored REAL, PRIMARY KEY (play, host))',
+        'CREATE TABLE IF NOT EXISTS remote_dirs (host TEXT, play TEXT, path TEXT, PRIMARY KEY (host, play))',
+        'CREATE TABLE IF NOT EXISTS remote_files (host TEXT, path TEXT, digest TEXT, PRIMARY KEY (host, path))',
+    )
+
+    # path -> (pid, connection, lock) of the connection this process keeps open on the database at path.
+    _connections = {}
+    _connections_lock = threading.Lock()
+
+    def __init__(self, path, ttl):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+
+    def _open(self):
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # timeout: How long to wait on a lock held by another fork before giving up.
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        # WAL lets readers in other forks carry on while one fork is writing.
+        conn.execute('PRAGMA journal_mode=WAL')
+        with conn:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+        return conn
+
+    # The connection of this process to the database, held for the duration of the with block.
+    @contextmanager
+    def _connect(self):
+        with FactCache._connections_lock:
+            pid, conn, lock = FactCache._connections.get(self.path, (None, None, None))
+            if pid != os.getpid():
+                conn, lock = self._open(), threading.Lock()
+                FactCache._connections[self.path] = (os.getpid(), conn, lock)
+        with lock:
+            yield conn
+
+    # Return a dict of the requested fact keys for host, or None if any of them is missing or older than the TTL.
+    def get(self, host, keys):
+        oldest = time.time() - self.ttl
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT key, value FROM facts WHERE host = ? AND stored >= ? AND key IN (%s)'
+                % ','.join('?' * len(keys)),
+                [host, oldest] + list(keys)
+            ).fetchall()
+
+        facts = dict((key, json.loads(value)) for key, value in rows)
+        if len(facts) != len(keys):
+            return None
+        return facts
+
+    def set(self, host, facts):
+        now = time.time()
+        with self._connect() as conn:
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO facts (host, key, value, stored) VALUES (?, ?, ?, ?)',
+                    [(host, key, json.dumps(value), now) for key, value in facts.items()]
+                )
+
+    # Bump the hit or miss counter of play and return its running totals as a dict. Counters of plays older than a
+    # day are dropped.
+    def record(self, play, hit):
+        name = 'hits' if hit else 'misses'
+        now = time.time()
+        with self._connect() as conn:
+            with conn:
+                conn.execute('DELETE FROM play_stats WHERE stored < ?', (now - 86400,))
+                conn.execute('INSERT OR IGNORE INTO play_stats (play, name, value, stored) VALUES (?, ?, 0, ?)',
+                             (play, name, now))
+                conn.execute('UPDATE play_stats SET value = value + 1, stored = ? WHERE play = ? AND name = ?',
+                             (now, play, name))
+            stats = dict(conn.execute('SELECT name, value FROM play_stats WHERE play = ?', (play,)).fetchall())
+
+        return dict(hits=stats.get('hits', 0), misses=stats.get('misses', 0))
+
+    # Claim the fleet wide probe of play. Exactly one fork gets True back; it is then responsible for probing every
+    # host of the play batch and publishing the results with publish_gate. Claims older than a day are dropped.
+    def claim_gate(self, play):
+        now = time.time()
+        with self._connect() as conn:
+            with conn:
+                conn.execute('DELETE FROM gate_claims WHERE claimed < ?', (now - 86400,))
+                conn.execute('DELETE FROM gate WHERE stored < ?', (now - 86400,))
+                claimed = conn.execute('INSERT OR IGNORE INTO gate_claims (play, claimed) VALUES (?, ?)',
+                                       (play, now)).rowcount
+        return claimed == 1
+
+    # Publish the probe result of host for play: a facts dict, or None when the host could not be probed.
+    def publish_gate(self, play, host, facts):
+        with self._connect() as conn:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO gate (play, host, facts, stored) VALUES (?, ?, ?, ?)',
+                             (play, host, json.dumps(facts), time.time()))
+
+    # Wait up to timeout seconds for the result of host in play to be published. Returns (published, facts).
+    def wait_gate(self, play, host, timeout, interval=0.2):
+        deadline = time.time() + timeout
+        while True:
+            with self._connect() as conn:
+                row = conn.execute('SELECT facts FROM gate WHERE play = ? AND host = ?', (play, host)).fetchone()
+            if row is not None:
+                return True, json.loads(row[0])
+            if time.time() >= deadline:
+                return False, None
+            time.sleep(interval)
+
+    # Add a latency sample of kind (probe or setup) for host, keeping only the newest keep samples.
+    def record_latency(self, host, kind, seconds, keep):
+        with self._connect() as conn:
+            with conn:
+                conn.execute('INSERT INTO latency (host, kind, stored, seconds) VALUES (?, ?, ?, ?)',
+                             (host, kind, time.time(), seconds))
+                conn.execute(
+                    'DELETE FROM latency WHERE host = ? AND kind = ? AND stored < '
+                    '(SELECT stored FROM latency WHERE host = ? AND kind = ? ORDER BY stored DESC LIMIT 1 OFFSET ?)',
+                    (host, kind, host, kind, keep - 1)
+                )
+
+    # The latency samples of kind for host, sorted from fastest to slowest.
+    def latencies(self, host, kind):
+        with self._connect() as conn:
+            rows = conn.execute('SELECT seconds FROM latency WHERE host = ? AND kind = ?', (host, kind)).fetchall()
+        return sorted(row[0] for row in rows)
+
+    # The persistent remote tmp dirs of host as a dict of play key to path.
+    def remote_dirs(self, host):
+        with self._connect() as conn:
+            return dict(conn.execute('SELECT play, path FROM remote_dirs WHERE host = ?', (host,)).fetchall())
+
+    def set_remote_dir(self, host, play, path):
+        with self._connect() as conn:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO remote_dirs (host, play, path) VALUES (?, ?, ?)',
+                             (host, play, path))
+
+    # Forget the remote tmp dirs of host for plays (all of them when plays is None), and the files uploaded to them.
+    def forget_remote_dirs(self, host, plays=None):
+        with self._connect() as conn:
+            with conn:
+                for play, path in conn.execute('SELECT play, path FROM remote_dirs WHERE host = ?', (host,)).fetchall():
+                    if plays is None or play in plays:
+                        conn.execute('DELETE FROM remote_files WHERE host = ? AND substr(path, 1, ?) = ?',
+                                     (host, len(path) + 1, path + '/'))
+                        conn.execute('DELETE FROM remote_dirs WHERE host = ? AND play = ?', (host, play))
+
+    # The digest of the last upload to path on host, or None.
+    def remote_digest(self, host, path):
+        with self._connect() as conn:
+            row = conn.execute('SELECT digest FROM remote_files WHERE host = ? AND path = ?', (host, path)).fetchone()
+        return row[0] if row else None
+
+    def set_remote_digest(self, host, path, digest):
+        with self._connect() as conn:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO remote_files (host, path, digest) VALUES (?, ?, ?)',
+                             (host, path, digest))
+
+
+# Accumulates wall clock time per named phase. Phases can nest (setup includes the transfer, remote_exec and parse
+# time of the module it runs) and a phase entered several times adds up.
+class PhaseTimer(object):
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.time() - start
+
+
 # Create our plugin based off of ActionBase from ansible.plugins.action . Our plugin class must be named ActionModule
 #
 # At a minimum, our ActionModule must have a defined run method.
@@ -57,8 +379,570 @@ class ActionModule(ActionBase):
     # In the case of TRANSFERS_FILES it is used by ActionBase to determine at which point in execution
     # temporary directories need to be available if your Action Plugin is using modules to
     # transfer files.
+    #
+    # This plugin never transfers files itself. With probe_mode=raw the decision is made from a single remote
+    # command, so no remote temporary directory is needed at all; only when the probe is inconclusive and we fall
+    # back to the setup module does _execute_module create (and clean up) one on demand.
     TRANSFERS_FILES = False
 
+    # Defaults for the controller side fact cache. They can be overridden per task with the fact_cache,
+    # fact_cache_path and fact_cache_ttl task arguments.
+    FACT_CACHE_PATH = '~/.ansible/cache/my_action_plugin_facts.sqlite'
+    FACT_CACHE_TTL = 3600
+
+    # Adaptive timeouts. Once a host has LATENCY_MIN_SAMPLES samples of a kind of call (probe or setup), its deadline
+    # for that call is TIMEOUT_MULTIPLIER times the p99 of its newest LATENCY_HISTORY samples, clamped to
+    # [TIMEOUT_MIN, TIMEOUT_MAX]. Before that, GATHER_TIMEOUT is used. With hedge=true a second probe is sent when
+    # the first has not answered after the host's HEDGE_PERCENTILE latency.
+    GATHER_TIMEOUT = 10
+    LATENCY_HISTORY = 50
+    LATENCY_MIN_SAMPLES = 5
+    TIMEOUT_MULTIPLIER = 3
+    TIMEOUT_MIN = 2
+    TIMEOUT_MAX = 60
+    HEDGE_PERCENTILE = 95
+
+    # Fleet wide gate (gate_mode=fleet). FLEET_WORKERS bounds how many hosts the first fork probes at once (override
+    # with fleet_workers), FLEET_WAIT is how long the other forks wait for their host's result before probing it
+    # themselves (override with fleet_wait).
+    FLEET_WORKERS = 20
+    FLEET_WAIT = 120
+
+    # Persistent remote tmp dir (persistent_tmp=true), one per host and play under remote_tmp. The name leaves out
+    # '-tmp-', which is what Ansible checks for before removing a remote tmp dir, but keeps 'tmp', which older
+    # versions require of a tmp path handed to _execute_module.
+    PERSISTENT_TMP_PREFIX = 'ansible-tmpcache-my_action_plugin-'
+
+    # Persistent tmp dirs left on a target for longer than PERSISTENT_TMP_MAX_AGE minutes (by mtime) are removed when
+    # a play creates its own, whichever controller they came from. This catches the dirs of the last play of a run,
+    # which no later play on this controller knows to remove, unless persistent_tmp_cleanup=true removed them.
+    PERSISTENT_TMP_MAX_AGE = 24 * 60
+
+    # What a failed run from the persistent tmp dir says when one of the files it reused is gone from the target
+    # (from the shell, the Python interpreter or the AnsiballZ wrapper). Only then is the run retried.
+    MISSING_FILE_RE = re.compile(r"No such file or directory|can't open file|: not found")
+
+    # AnsiballZ writes the time the payload was built into the wrapper, as the date of a zip entry it creates on the
+    # target (a tuple before ansible-core 2.19, a datetime since). It is left out of the payload digest: payloads that
+    # only differ there behave the same.
+    ANSIBALLZ_DATE_RE = re.compile(br'date_time ?= ?(\([0-9, ]*\)|datetime\.datetime\([^)]*\))')
+
+    # The NAME=value assignments at the start of a shell command. Values are shell words, quoted or not, the way
+    # _compute_environment_string writes them.
+    ENV_ASSIGNMENTS_RE = re.compile(r'''\s*(?:[A-Za-z_][A-Za-z0-9_]*=(?:'[^']*'|"(?:[^"\\]|\\.)*"|[^\s'"])*\s+)*''')
+
+    # The facts this plugin needs in order to make its decision.
+    REQUIRED_FACTS = ('ansible_system',)
+
+    # Cheap facts that can be read with a plain shell command instead of the setup module, and the command that
+    # produces each of them. They are all batched into a single remote shell invocation by _probe_facts.
+    PROBE_COMMANDS = (
+        ('ansible_system', 'uname -s'),
+        ('ansible_kernel', 'uname -r'),
+        ('ansible_machine', 'uname -m'),
+    )
+
+    # Look up facts that are already known to the controller, either because they were gathered earlier in the
+    # play (gather_facts or a previous setup task) or because they were loaded from a fact caching plugin.
+    # Facts can show up as top level ansible_* variables, under the ansible_facts namespace without the ansible_
+    # prefix, or in hostvars for the current host.
+    def _facts_from_task_vars(self, task_vars, keys):
+        host = task_vars.get('inventory_hostname')
+        sources = [task_vars]
+        hostvars = task_vars.get('hostvars', {})
+        if host in hostvars:
+            sources.append(hostvars[host])
+
+        facts = {}
+        for key in keys:
+            short_key = key[len('ansible_'):] if key.startswith('ansible_') else key
+            for source in sources:
+                if key in source:
+                    facts[key] = source[key]
+                    break
+                if short_key in source.get('ansible_facts', {}):
+                    facts[key] = source['ansible_facts'][short_key]
+                    break
+
+        if len(facts) != len(keys):
+            return None
+        return facts
+
+    # Work out the smallest gather_subset that still produces every fact in keys.
+    #
+    # Each collector class in default_collectors.collectors has a name (the value accepted by gather_subset) and a
+    # set of _fact_ids it produces, without the ansible_ prefix. Returns a sorted list of collector names, or None
+    # if a key is not produced by any known collector, in which case the caller should fall back to 'all'.
+    def _resolve_gather_subset(self, keys):
+        names = set()
+        for key in keys:
+            short_key = key[len('ansible_'):] if key.startswith('ansible_') else key
+            for collector_class in default_collectors.collectors:
+                if short_key == collector_class.name or short_key in collector_class._fact_ids:
+                    names.add(collector_class.name)
+                    break
+            else:
+                return None
+        return sorted(names)
+
+    # ActionBase overrides that time the low level steps of every module call into the phase timer of the current run:
+    #
+    # * _transfer_data: Writing the module payload (and its arguments) to the remote tmp dir.
+    # * _low_level_execute_command: Every remote command, including the raw probe, creating and removing the remote
+    #   tmp dir and running the module itself. While _module_deadline is set (see _run_setup) the module run is
+    #   wrapped in timeout(1) on the target, so it is killed there once the deadline has passed. Targets without
+    #   timeout(1) (or a POSIX shell) run it unbounded. The module command starts with the task's environment as
+    #   NAME=value assignments, so timeout goes after them: the assignments still apply to whatever follows them.
+    # * _parse_returned_data: Turning the JSON the module printed back into a dict on the controller, including
+    #   unpacking results returned in the compact output_format=zlib wire format.
+    def _timed(self, phase, method, *args, **kwargs):
+        timer = getattr(self, '_timer', None)
+        if timer is None:
+            return method(*args, **kwargs)
+        with timer.phase(phase):
+            return method(*args, **kwargs)
+
+    # With persistent_tmp, an upload is skipped when the same content (by digest) was already uploaded to the same
+    # path of the persistent tmp dir.
+    def _transfer_data(self, remote_path, data):
+        persistent = getattr(self, '_persistent', None)
+        if persistent is None:
+            return self._timed('transfer', super(ActionModule, self)._transfer_data, remote_path, data)
+
+        content = json.dumps(data, sort_keys=True) if isinstance(data, dict) else data
+        digest = hashlib.sha1(self.ANSIBALLZ_DATE_RE.sub(b'', to_bytes(content))).hexdigest()
+        if persistent['fact_cache'].remote_digest(persistent['host'], remote_path) == digest:
+            persistent['reused'].add(remote_path)
+            return remote_path
+
+        remote_path = self._timed('transfer', super(ActionModule, self)._transfer_data, remote_path, data)
+        persistent['fact_cache'].set_remote_digest(persistent['host'], remote_path, digest)
+        return remote_path
+
+    # The permissions of reused files (and of the persistent tmp dir) were fixed when they were first uploaded, so
+    # the chmod round trip is skipped when nothing new was uploaded.
+    def _fixup_perms2(self, remote_paths, *args, **kwargs):
+        persistent = getattr(self, '_persistent', None)
+        if persistent is not None and \
+                all(path == persistent['tmpdir'] or path in persistent['reused'] for path in remote_paths):
+            return remote_paths
+        return super(ActionModule, self)._fixup_perms2(remote_paths, *args, **kwargs)
+
+    def _low_level_execute_command(self, cmd, *args, **kwargs):
+        deadline = getattr(self, '_module_deadline', None)
+        if deadline is not None and getattr(self._connection._shell, 'SHELL_FAMILY', None) != 'powershell' and \
+                (kwargs.get('in_data') is not None or 'AnsiballZ_' in cmd):
+            assignments = self.ENV_ASSIGNMENTS_RE.match(cmd).group(0)
+            cmd = '%s$(command -v timeout >/dev/null 2>&1 && echo timeout %d) %s' % (
+                assignments, deadline, cmd[len(assignments):]
+            )
+        return self._timed('remote_exec', super(ActionModule, self)._low_level_execute_command, cmd, *args, **kwargs)
+
+    def _parse_returned_data(self, *args, **kwargs):
+        return self._timed('parse', self._parse_compact, *args, **kwargs)
+
+    def _parse_compact(self, *args, **kwargs):
+        data = super(ActionModule, self)._parse_returned_data(*args, **kwargs)
+        try:
+            return decode_compact_result(data)
+        except (KeyError, TypeError, ValueError, zlib.error) as e:
+            data['failed'] = True
+            data['msg'] = 'could not decode the compact module result: %s' % e
+            return data
+
+    # Read the PROBE_COMMANDS facts with one raw command, skipping the AnsiballZ upload, unpack and Python start up
+    # that the setup module costs. Each probe prints a key=value line so the output can be split apart again.
+    #
+    # Returns the probed facts, or None if the probe is inconclusive (non zero exit code, for example on hosts without
+    # a POSIX shell, or one of the keys in keys came back empty) so the caller can fall back to the setup module.
+    def _probe_facts(self, keys):
+        probe_result = self._low_level_execute_command(self._probe_command(), sudoable=False)
+        return self._parse_probe(probe_result.get('rc'), probe_result.get('stdout', ''), keys)
+
+    def _probe_command(self):
+        return '; '.join(
+            'echo "%s=$(%s 2>/dev/null)"' % (key, probe) for key, probe in self.PROBE_COMMANDS
+        )
+
+    def _parse_probe(self, rc, stdout, keys):
+        if rc != 0:
+            return None
+
+        facts = {}
+        for line in stdout.splitlines():
+            key, sep, value = line.strip().partition('=')
+            if sep and value:
+                facts[key] = value
+
+        if not all(key in facts for key in keys):
+            return None
+        return facts
+
+    # The deadline in seconds for a call of kind on a host with the given latency samples, or None when there are
+    # not enough samples yet to base one on.
+    def _adaptive_deadline(self, samples):
+        if len(samples) < self.LATENCY_MIN_SAMPLES:
+            return None
+        deadline = percentile(samples, 99) * self.TIMEOUT_MULTIPLIER
+        return min(max(deadline, self.TIMEOUT_MIN), self.TIMEOUT_MAX)
+
+    # Run the raw probe with a deadline, and optionally a single hedged retry.
+    #
+    # The probe runs on a daemon thread so we can stop waiting for it at the deadline. When hedge_after is set and
+    # the probe has not answered by then, a second, identical probe is sent and whichever answers first wins. The
+    # probe only reads state, so running it twice is harmless. Returns (facts, hedged), with facts None when no probe
+    # answered conclusively in time.
+    #
+    # Every attempt runs over a connection of its own, never over self._connection: a thread that misses the deadline
+    # cannot be stopped, so it is abandoned and closes its connection whenever its command returns, while the setup
+    # fallback goes on over self._connection. With ssh and ControlPersist the connections still share one master, so
+    # a stalled master stalls every attempt alike.
+    def _probe_facts_within(self, keys, deadline, hedge_after, task_vars):
+        answers = []
+        answered = threading.Condition()
+
+        def attempt(connection):
+            try:
+                facts = self._probe_over(connection, keys)
+            except Exception as e:
+                display.vvv('my_action_plugin: probe failed: %s' % e)
+                facts = None
+            with answered:
+                answers.append(facts)
+                answered.notify()
+
+        # The connection is set up here rather than on the thread, so no templating happens off the main thread.
+        def start_attempt():
+            thread = threading.Thread(target=attempt, args=(self._new_connection(self._play_context, task_vars,
+                                                                                   self._templar),))
+            thread.daemon = True
+            thread.start()
+
+        start = time.time()
+        attempts = 1
+        start_attempt()
+        with answered:
+            while True:
+                if any(facts is not None for facts in answers) or len(answers) == attempts:
+                    break
+                now = time.time()
+                if now >= start + deadline:
+                    break
+                if hedge_after is not None and attempts == 1 and now >= start + hedge_after:
+                    attempts += 1
+                    start_attempt()
+                    continue
+
+                wake = start + deadline
+                if hedge_after is not None and attempts == 1:
+                    wake = min(wake, start + hedge_after)
+                answered.wait(wake - now)
+
+        for facts in answers:
+            if facts is not None:
+                return facts, attempts > 1
+        return None, attempts > 1
+
+    # A key identifying the current play batch in every fork: the ansible-playbook process (the parent of the forks),
+    # the play and the hosts of the batch.
+    def _play_key(self, task_vars):
+        play = getattr(getattr(self._task, '_parent', None), '_play', None)
+        batch = ','.join(sorted(task_vars.get('ansible_play_batch', [])))
+        return '%s:%s:%s' % (os.getppid(), getattr(play, '_uuid', ''), hashlib.sha1(to_bytes(batch)).hexdigest())
+
+    # Probe another host of the play over a connection of its own, set up from its host vars the same way the
+    # TaskExecutor sets up ours: its play context and connection vars are templated with its own vars, not ours.
+    # Returns the probed facts or None.
+    def _probe_other_host(self, other_host, task_vars):
+        variables = task_vars['hostvars'][other_host]
+        templar = Templar(loader=self._loader, variables=variables)
+        play_context = self._play_context.set_task_and_variable_override(
+            task=self._task,
+            variables=variables,
+            templar=templar
+        )
+        play_context.post_validate(templar=templar)
+        if not play_context.remote_addr:
+            play_context.remote_addr = other_host
+        if 'ansible_connection' in variables:
+            play_context.connection = templar.template(variables['ansible_connection'])
+        return self._probe_over(self._new_connection(play_context, variables, templar), self.REQUIRED_FACTS)
+
+    # A new connection for the given play context and host vars, separate from self._connection. Its options are
+    # set the way the TaskExecutor sets them (see TaskExecutor._set_connection_options): the task's attributes with
+    # the connection timeout and password of the play context, and the templated vars of the connection plugin.
+    def _new_connection(self, play_context, variables, templar):
+        connection = self._shared_loader_obj.connection_loader.get(play_context.connection, play_context, os.devnull)
+        if not connection:
+            raise AnsibleError("the connection plugin '%s' was not found" % play_context.connection)
+        if not hasattr(connection, 'set_options'):
+            return connection
+
+        task_keys = self._task.dump_attrs()
+        task_keys['timeout'] = play_context.timeout
+        if play_context.password:
+            task_keys['password'] = play_context.password
+        # The task's retries are not the connection's.
+        task_keys.pop('retries', None)
+
+        if hasattr(connection, '_resolve_option_variables'):
+            var_options = connection._resolve_option_variables(variables, templar)
+        else:
+            # Older versions template the connection plugin's vars themselves.
+            var_options = dict(
+                (name, templar.template(variables[name]))
+                for name in C.config.get_plugin_vars('connection', connection._load_name) if name in variables
+            )
+        connection.set_options(task_keys=task_keys, var_options=var_options)
+        return connection
+
+    # Run the raw probe over connection and close it. Returns the probed facts or None.
+    def _probe_over(self, connection, keys):
+        # Wrap the probe in the remote shell the same way _low_level_execute_command does for our own host.
+        command = '%s -c %s' % (C.DEFAULT_EXECUTABLE, shlex_quote(self._probe_command()))
+        try:
+            rc, stdout, stderr = connection.exec_command(command, sudoable=False)
+        finally:
+            connection.close()
+        return self._parse_probe(rc, to_text(stdout, errors='surrogate_or_strict'), keys)
+
+    # Probe every host of the play batch through a pool of at most workers threads and publish each result in the
+    # gate table as soon as it is known, so forks waiting on a host can carry on without waiting for the whole fleet.
+    # Hosts with fresh facts in the fact cache are published straight from the cache.
+    #
+    # This runs in the fork that won claim_gate, which has to wait for the whole batch: the worker process exits, and
+    # takes any running threads with it, as soon as its task returns.
+    def _fleet_probe(self, play, task_vars, fact_cache, workers):
+        host = task_vars.get('inventory_hostname')
+        pending = queue.Queue()
+        for other_host in task_vars.get('ansible_play_batch') or [host]:
+            pending.put(other_host)
+
+        def worker():
+            while True:
+                try:
+                    other_host = pending.get_nowait()
+                except queue.Empty:
+                    return
+
+                facts = fact_cache.get(other_host, self.REQUIRED_FACTS)
+                if facts is None:
+                    try:
+                        if other_host == host:
+                            facts = self._probe_facts(self.REQUIRED_FACTS)
+                        else:
+                            facts = self._probe_other_host(other_host, task_vars)
+                    except Exception as e:
+                        display.vvv('my_action_plugin: fleet probe of %s failed: %s' % (other_host, e))
+                    if facts is not None:
+                        fact_cache.set(other_host, facts)
+                fact_cache.publish_gate(play, other_host, facts)
+
+        threads = [threading.Thread(target=worker) for _ in range(max(1, min(workers, pending.qsize())))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    # gate_mode=fleet: the first fork to get here probes the whole play batch once, every other invocation (on any
+    # fork, for any later task of the play) just reads its host's result. Returns None when no result turned up, in
+    # which case the caller probes the host itself.
+    def _fleet_facts(self, task_vars, fact_cache):
+        try:
+            workers = int(self._task.args.get('fleet_workers', self.FLEET_WORKERS))
+            wait = float(self._task.args.get('fleet_wait', self.FLEET_WAIT))
+        except (TypeError, ValueError):
+            raise AnsibleError('fleet_workers and fleet_wait must be numbers')
+
+        play = self._play_key(task_vars)
+        if fact_cache.claim_gate(play):
+            self._fleet_probe(play, task_vars, fact_cache, workers)
+
+        published, facts = fact_cache.wait_gate(play, task_vars.get('inventory_hostname'), wait)
+        return facts
+
+    # Whether modules are piped to the target rather than uploaded, in which case there is nothing to keep around.
+    def _pipelining(self):
+        if hasattr(self, '_is_pipelining_enabled'):
+            return self._is_pipelining_enabled('new')
+        return bool(self._play_context.pipelining and getattr(self._connection, 'has_pipelining', False))
+
+    # The (unexpanded) base dir of remote tmp dirs on the target.
+    def _remote_tmp_base(self):
+        try:
+            return self._connection._shell.get_option('remote_tmp')
+        except Exception:
+            return getattr(C, 'DEFAULT_REMOTE_TMP', '~/.ansible/tmp')
+
+    # Whether the play with the given play key is over: an earlier play of this ansible-playbook run, or a play of a
+    # run whose process is gone.
+    @staticmethod
+    def _play_finished(play):
+        try:
+            pid = int(play.split(':', 1)[0])
+        except ValueError:
+            return True
+        if pid == os.getppid():
+            return True
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno == errno.ESRCH
+        return False
+
+    # This host's persistent tmp dir for the current play. The first call of the play creates it, in the same round
+    # trip that removes the dirs of finished plays and any older than PERSISTENT_TMP_MAX_AGE. Returns None if the dir
+    # could not be created.
+    def _persistent_tmpdir(self, host, task_vars, fact_cache):
+        play = self._play_key(task_vars)
+        dirs = fact_cache.remote_dirs(host)
+        if play in dirs:
+            return dirs[play]
+
+        # Quote everything but a leading ~/ so the remote shell still expands it.
+        base = self._remote_tmp_base().rstrip('/')
+        if base.startswith('~/'):
+            base = '~/' + shlex_quote(base[2:])
+        else:
+            base = shlex_quote(base)
+        tmpdir = '%s/%s%s' % (base, self.PERSISTENT_TMP_PREFIX, hashlib.sha1(to_bytes(play)).hexdigest()[:12])
+
+        stale = [other for other in dirs if other != play and self._play_finished(other)]
+        commands = ['rm -f -r %s' % shlex_quote(dirs[other]) for other in stale]
+        commands.append('find %s -maxdepth 1 -type d -name %s -mmin +%d -exec rm -f -r {} + 2>/dev/null'
+                        % (base, shlex_quote(self.PERSISTENT_TMP_PREFIX + '*'), self.PERSISTENT_TMP_MAX_AGE))
+        commands.append('( umask 77 && mkdir -p %s && cd %s && pwd )' % (tmpdir, tmpdir))
+        res = self._low_level_execute_command('; '.join(commands), sudoable=False)
+        fact_cache.forget_remote_dirs(host, stale)
+
+        lines = res.get('stdout', '').strip().splitlines()
+        if res.get('rc') != 0 or not lines:
+            display.vvv('my_action_plugin: could not create a persistent tmp dir on %s: %s'
+                        % (host, res.get('stderr', '')))
+            return None
+        fact_cache.set_remote_dir(host, play, lines[-1])
+        return lines[-1]
+
+    # Remove this host's persistent tmp dir of the current play, if it has one. Returns the removed path or None.
+    def _remove_persistent_tmpdir(self, host, task_vars, fact_cache):
+        play = self._play_key(task_vars)
+        tmpdir = fact_cache.remote_dirs(host).get(play)
+        if tmpdir is None:
+            return None
+
+        res = self._low_level_execute_command('rm -f -r %s' % shlex_quote(tmpdir), sudoable=False)
+        fact_cache.forget_remote_dirs(host, [play])
+        if res.get('rc') != 0:
+            display.vvv('my_action_plugin: could not remove the persistent tmp dir on %s: %s'
+                        % (host, res.get('stderr', '')))
+            return None
+        return tmpdir
+
+    # Run a module from the persistent tmp dir of the play rather than from a throw-away one, so only the run itself
+    # costs a round trip once the payload is there. Falls back to a plain _execute_module if the dir cannot be made.
+    def _execute_module_persistent(self, fact_cache, **module_kwargs):
+        task_vars = module_kwargs['task_vars']
+        host = task_vars.get('inventory_hostname')
+        shell = self._connection._shell
+        for attempt in (1, 2):
+            tmpdir = self._persistent_tmpdir(host, task_vars, fact_cache)
+            if tmpdir is None:
+                return self._execute_module(**module_kwargs)
+
+            # Newer Ansible versions take the tmp dir from the shell and ignore (with a warning) the tmp argument.
+            persistent_kwargs = dict(module_kwargs, persist_files=True, delete_remote_tmp=False)
+            if hasattr(shell, 'tmpdir'):
+                shell.tmpdir = tmpdir
+            else:
+                persistent_kwargs['tmp'] = tmpdir
+
+            self._persistent = dict(fact_cache=fact_cache, host=host, tmpdir=tmpdir, reused=set())
+            try:
+                module_result = self._execute_module(**persistent_kwargs)
+            finally:
+                reused = self._persistent['reused']
+                self._persistent = None
+                # Nothing left for ActionBase.cleanup to remove at the end of the task.
+                if hasattr(shell, 'tmpdir'):
+                    shell.tmpdir = None
+
+            self._persistent_report = dict(path=tmpdir, reused=sorted(reused))
+            if not (module_result.get('failed') and reused and self._missing_file(module_result)) or attempt == 2:
+                return module_result
+
+            # A reused file is gone from the target (the dir was removed by hand, or remote_tmp is cleared at boot).
+            # Forget what was uploaded to the host and try once more with fresh uploads. Any other failure is the
+            # module's own and is returned as is, rather than paying for a second run that fails the same way.
+            display.vvv('my_action_plugin: run from the persistent tmp dir failed on %s, uploading again' % host)
+            fact_cache.forget_remote_dirs(host)
+
+    def _missing_file(self, module_result):
+        return any(
+            self.MISSING_FILE_RE.search(to_text(module_result.get(key) or ''))
+            for key in ('module_stderr', 'module_stdout', 'msg')
+        )
+
+    # Run the setup module for the REQUIRED_FACTS and return its result.
+    #
+    # deadline is the host's adaptive setup deadline in seconds, or None. gather_timeout only bounds each fact
+    # collector, not the run, so with a deadline a synchronous run is also killed on the target once it has run
+    # for that long (see _low_level_execute_command) and comes back with rc 124. That costs no extra round trip;
+    # _run_gate then retries once without a deadline.
+    #
+    # With the persistent_tmp task argument, setup runs from a remote tmp dir kept for the whole play and its payload
+    # is only uploaded when it changed (see _execute_module_persistent). Set persistent_tmp_cleanup=true on the last
+    # task of the play using persistent_tmp to remove the dir when that task is done (see run).
+    def _run_setup(self, tmp, task_vars, gather_timeout, fact_cache, deadline=None):
+        persistent_tmp = boolean(self._task.args.get('persistent_tmp', False))
+
+        # Execute another Ansible module
+        #
+        # Only ask setup for the collectors that produce the facts we need. '!all' and '!min' switch off the
+        # default and minimal collectors so nothing else runs on the target, and filter trims the returned JSON down
+        # to the keys we read (older setup versions only accept a single filter pattern).
+        gather_subset = self._resolve_gather_subset(self.REQUIRED_FACTS)
+        if gather_subset is None:
+            setup_module_args=dict(
+                gather_subset='all',
+                gather_timeout=gather_timeout
+            )
+        else:
+            setup_module_args=dict(
+                gather_subset=['!all', '!min'] + gather_subset,
+                gather_timeout=gather_timeout
+            )
+            if len(self.REQUIRED_FACTS) == 1:
+                setup_module_args['filter'] = self.REQUIRED_FACTS[0]
+            else:
+                setup_module_args['filter'] = list(self.REQUIRED_FACTS)
+
+        # Run the setup module to collect facts
+        #
+        # delete_remote_tmp: Boolean that determines whether the remote tmp directory and files are deleted.
+        # module_name: The name of the Ansible module to run.
+        # module_args: A dict of arguments to provide to the Ansible module.
+        # persist_files: Boolean that determins whether or not to keep temporary files.
+        # task_vars: The task variables for the current play context.
+        # tmp: The path to the temporary directory.
+        # wrap_async: Boolean that controls whether or not the task is run asyncronously.
+        setup_kwargs = dict(
+            delete_remote_tmp=True,
+            module_name='setup',
+            module_args=setup_module_args,
+            persist_files=False,
+            task_vars=task_vars,
+            tmp=tmp
+        )
+
+        self._module_deadline = None if deadline is None else int(math.ceil(deadline))
+        try:
+            if persistent_tmp and not self._pipelining():
+                return self._execute_module_persistent(fact_cache, wrap_async=False, **setup_kwargs)
+            return self._execute_module(wrap_async=False, **setup_kwargs)
+        finally:
+            self._module_deadline = None
+
     # The run method is the main Action Plugin driver. All work is done from within this method.
     #
     # tmp: Temporary directory. Sometimes an action plugin sets up
@@ -78,6 +962,18 @@ class ActionModule(ActionBase):
         # all the run will do is a validation.
         #
         # For a list of common properties included in a result, see ansible/utils/module_docs_fragments/return_common.py
+        #
+        # Support for check mode and async has to be declared before calling the parent, as that is where ActionBase
+        # rejects tasks using features the plugin does not support.
+        #
+        # Async is not supported. With it the TaskExecutor polls the job id we return and replaces our result with
+        # the raw setup output, and an action plugin cannot give its fork back while setup runs in any case: the
+        # worker is busy until run returns. Setup is always run synchronously (wrap_async=False, rather than the
+        # task's async value, whose attribute name is a keyword since Python 3.7) and bounded by its adaptive
+        # deadline instead.
+        self._supports_check_mode = True
+        self._supports_async = False
+
         result = super(ActionModule, self).run(tmp, task_vars)
 
         # Initialize result object with some of the return_common values:
@@ -90,36 +986,175 @@ class ActionModule(ActionBase):
             )
         )
 
-        # Define support for check mode and async
-        self._supports_check_mode = True
-        self._supports_async = False
+        # Time each phase of the run and return the timings under phase_timings, where my_callback_plugin picks
+        # them up to build per host and fleet wide latency histograms.
+        self._timer = PhaseTimer()
 
-        # Execute another Ansible module
-        setup_module_args=dict(
-            gather_subset='all',
-            gather_timeout=10
-        )
+        # With the profile task argument (or MY_ACTION_PLUGIN_PROFILE on the controller) set to N, the run is
+        # profiled and the N hottest functions and allocating lines are returned under profile.
+        try:
+            profile_top = int(self._task.args.get('profile', os.environ.get('MY_ACTION_PLUGIN_PROFILE') or 0))
+        except (TypeError, ValueError):
+            raise AnsibleError('profile must be a number of entries to report')
+        profile = start_profile() if profile_top > 0 else None
 
-        # Run the setup module to collect facts
+        with self._timer.phase('total'):
+            try:
+                self._run_gate(result, tmp, task_vars)
+
+                # persistent_tmp_cleanup=true: this is the last task of the play using the persistent tmp dir, so
+                # remove it from the host now rather than leave it for a later play (or the age based sweep).
+                if boolean(self._task.args.get('persistent_tmp', False)) and \
+                        boolean(self._task.args.get('persistent_tmp_cleanup', False)):
+                    with self._timer.phase('cleanup'):
+                        self._cleanup_persistent_tmp(result, task_vars or dict())
+            finally:
+                if profile is not None:
+                    result['profile'] = stop_profile(profile, profile_top)
+        result['phase_timings'] = self._timer.timings
+
+        return result
+
+    def _cleanup_persistent_tmp(self, result, task_vars):
+        fact_cache = FactCache(self._task.args.get('fact_cache_path', self.FACT_CACHE_PATH), self.FACT_CACHE_TTL)
+        removed = self._remove_persistent_tmpdir(task_vars.get('inventory_hostname'), task_vars, fact_cache)
+        if removed is not None:
+            result.setdefault('persistent_tmp', dict(path=removed, reused=[]))['removed'] = True
+
+    # The OS gate itself: find ansible_system as cheaply as possible and fail the task if the host is not Linux.
+    def _run_gate(self, result, tmp, task_vars):
+        timer = self._timer
+        task_vars = task_vars or dict()
+        host = task_vars.get('inventory_hostname')
+
+        # Before paying for a remote round trip, use the facts the controller already has: first the task
+        # variables, then the persistent fact cache shared by all forks.
         #
-        # delete_remote_tmp: Boolean that determines whether the remote tmp directory and files are deleted.
-        # module_name: The name of the Ansible module to run.
-        # module_args: A dict of arguments to provide to the Ansible module.
-        # persist_files: Boolean that determins whether or not to keep temporary files.
-        # task_vars: The task variables for the current play context.
-        # tmp: The path to the temporary directory.
-        # wrap_async: Boolean that controls whether or not the task is run asyncronously.
-        setup_result = self._execute_module(
-            delete_remote_tmp=True,
-            module_name='setup',
-            module_args=setup_module_args,
-            persist_files=False,
-            task_vars=task_vars,
-            tmp=tmp,
-            wrap_async=self._task.async
-        )
+        # fact_cache=false leaves the controller database alone altogether. That also turns off the adaptive
+        # timeouts, which are derived from the latency history kept in it.
+        use_fact_cache = boolean(self._task.args.get('fact_cache', True))
+        try:
+            fact_cache_ttl = int(self._task.args.get('fact_cache_ttl', self.FACT_CACHE_TTL))
+        except (TypeError, ValueError):
+            raise AnsibleError('fact_cache_ttl must be an integer number of seconds')
+        fact_cache = None
+        if use_fact_cache:
+            fact_cache = FactCache(self._task.args.get('fact_cache_path', self.FACT_CACHE_PATH), fact_cache_ttl)
 
-        if setup_result['ansible_facts']['ansible_system'] != 'Linux':
-            result['failed'] = True
+        # With probe_mode=raw try the single round trip probe before the setup module.
+        probe_mode = self._task.args.get('probe_mode', 'setup')
+        if probe_mode not in ('setup', 'raw'):
+            raise AnsibleError('probe_mode must be one of: setup, raw')
+
+        with timer.phase('lookup'):
+            facts = self._facts_from_task_vars(task_vars, self.REQUIRED_FACTS)
+            source = 'task_vars'
+            if facts is None and use_fact_cache:
+                facts = fact_cache.get(host, self.REQUIRED_FACTS)
+                source = 'cache'
+        cache_hit = facts is not None
+
+        # With gate_mode=fleet the probe is paid for once per play batch rather than once per host and task.
+        gate_mode = self._task.args.get('gate_mode', 'host')
+        if gate_mode not in ('host', 'fleet'):
+            raise AnsibleError('gate_mode must be one of: host, fleet')
+        if fact_cache is None and (gate_mode == 'fleet' or boolean(self._task.args.get('persistent_tmp', False))):
+            raise AnsibleError('gate_mode=fleet and persistent_tmp keep their state in the fact cache database and '
+                               'cannot be used with fact_cache=false')
 
-        return result
\ No newline at end of file
+        if facts is None and gate_mode == 'fleet':
+            with timer.phase('fleet'):
+                facts = self._fleet_facts(task_vars, fact_cache)
+            source = 'fleet'
+
+        # Derive this host's deadlines from its own latency history.
+        adaptive = boolean(self._task.args.get('adaptive_timeout', True))
+        hedge = boolean(self._task.args.get('hedge', False))
+        probe_deadline = None
+        setup_deadline = None
+        gather_timeout = self.GATHER_TIMEOUT
+        if facts is None and adaptive and fact_cache is not None:
+            probe_samples = fact_cache.latencies(host, 'probe')
+            probe_deadline = self._adaptive_deadline(probe_samples)
+            setup_deadline = self._adaptive_deadline(fact_cache.latencies(host, 'setup'))
+            if setup_deadline is not None:
+                gather_timeout = int(math.ceil(setup_deadline))
+            result['adaptive_timeout'] = dict(probe_deadline=probe_deadline, setup_deadline=setup_deadline,
+                                              gather_timeout=gather_timeout)
+
+        # Connections are opened lazily by the first remote command; open it up front so connection set up shows up
+        # as its own phase instead of being hidden in the first remote_exec. A probe with a deadline runs over
+        # connections of its own (see _probe_facts_within), so ours is only opened when setup needs it.
+        if facts is None and probe_mode == 'raw' and probe_deadline is None:
+            with timer.phase('connect'):
+                self._connection._connect()
+
+        if facts is None and probe_mode == 'raw':
+            with timer.phase('probe'):
+                probe_start = time.time()
+                if probe_deadline is None:
+                    facts = self._probe_facts(self.REQUIRED_FACTS)
+                else:
+                    hedge_after = percentile(probe_samples, self.HEDGE_PERCENTILE) if hedge else None
+                    facts, hedged = self._probe_facts_within(self.REQUIRED_FACTS, probe_deadline, hedge_after,
+                                                             task_vars)
+                    result['adaptive_timeout']['hedged'] = hedged
+                # A probe that did not answer in time took at least the deadline. Recording that as its latency lets
+                # the deadline grow with a host that got slower instead of missing it for good.
+                probe_seconds = time.time() - probe_start
+                if facts is None:
+                    timed_out = probe_deadline is not None and probe_seconds >= probe_deadline
+                    probe_seconds = probe_deadline if timed_out else None
+                if probe_seconds is not None and fact_cache is not None:
+                    fact_cache.record_latency(host, 'probe', probe_seconds, self.LATENCY_HISTORY)
+            source = 'probe'
+            if facts is None:
+                display.vvv('my_action_plugin: raw probe inconclusive on %s, falling back to setup' % host)
+
+        # Only pay for the setup module when nothing cheaper could answer.
+        if facts is None:
+            if not self._connection.connected:
+                with timer.phase('connect'):
+                    self._connection._connect()
+
+            with timer.phase('setup'):
+                setup_start = time.time()
+                setup_result = self._run_setup(tmp, task_vars, gather_timeout, fact_cache, setup_deadline)
+                setup_seconds = time.time() - setup_start
+
+                # timeout(1) exits with 124 when it had to kill the run. The run took at least the deadline, which is
+                # recorded so the deadline can grow with the host; then setup is retried once without a deadline.
+                if setup_deadline is not None and setup_result.get('rc') == 124:
+                    display.vvv('my_action_plugin: setup on %s did not finish within %ds, retrying without a deadline'
+                                % (host, math.ceil(setup_deadline)))
+                    fact_cache.record_latency(host, 'setup', setup_deadline, self.LATENCY_HISTORY)
+                    result['adaptive_timeout']['retried'] = True
+                    setup_start = time.time()
+                    setup_result = self._run_setup(tmp, task_vars, self.GATHER_TIMEOUT, fact_cache)
+                    setup_seconds = time.time() - setup_start
+
+            # With persistent_tmp, report the dir setup ran from and the uploads that were skipped.
+            if getattr(self, '_persistent_report', None) is not None:
+                result['persistent_tmp'] = self._persistent_report
+
+            if setup_result.get('failed') or 'ansible_facts' not in setup_result:
+                result['failed'] = True
+                result['msg'] = setup_result.get('msg', 'setup did not return any facts')
+                return
+
+            # Keep just the keys we need so the rest of the (potentially very large) setup result can be released.
+            facts = dict((key, setup_result['ansible_facts'][key]) for key in self.REQUIRED_FACTS)
+            source = 'setup'
+            if fact_cache is not None:
+                fact_cache.record_latency(host, 'setup', setup_seconds, self.LATENCY_HISTORY)
+
+        # The hit and miss counters reported are those of the current play batch.
+        if fact_cache is not None:
+            with timer.phase('cache_update'):
+                if not cache_hit:
+                    fact_cache.set(host, facts)
+                result['fact_cache'] = fact_cache.record(self._play_key(task_vars), hit=cache_hit)
+            result['fact_cache']['source'] = source
+
+        if facts['ansible_system'] != 'Linux':
+            result['failed'] = True
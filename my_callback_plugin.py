@@ -0,0 +1,162 @@
+# For a high level over see video at https://www.ansible.com/blog/how-to-extend-ansible-through-plugins
+
+# Standard base includes and define this as a metaclass of type
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# Callback plugins need a DOCUMENTATION block just like modules. The options declared here can be set in the
+# [callback_my_callback_plugin] section of ansible.cfg or with the matching environment variables.
+DOCUMENTATION = '''
+    callback: my_callback_plugin
+    type: aggregate
+    short_description: Aggregate phase timings into per host and fleet wide latency reports
+    version_added: "2.4"
+    description:
+        - Collects the C(phase_timings) returned by my_action_plugin and my_module for every task on every host.
+        - At the end of the playbook it prints the slowest hosts and, for each phase, fleet wide percentiles and a
+          latency histogram.
+    requirements:
+        - Whitelist in configuration (C(callback_whitelist) or C(callbacks_enabled))
+    options:
+        top_hosts:
+            description: Number of slowest hosts to list.
+            default: 10
+            env:
+                - name: MY_CALLBACK_TOP_HOSTS
+            ini:
+                - section: callback_my_callback_plugin
+                  key: top_hosts
+            type: int
+'''
+
+import math
+
+# ADT base class for our Ansible Callback Plugin
+from ansible.plugins.callback import CallbackBase
+
+# Percentiles reported for every phase.
+PERCENTILES = (50, 90, 99)
+
+# Upper bounds (in seconds) of the histogram buckets. Anything slower lands in the last, open ended, bucket.
+HISTOGRAM_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+# Width of the longest bar in the histogram.
+HISTOGRAM_WIDTH = 40
+
+
+# Nearest rank percentile of an already sorted list.
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(sorted_values))) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+# Count values per HISTOGRAM_BUCKETS bucket. Returns a list of (label, count).
+def histogram(values):
+    counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+    for value in values:
+        for index, bound in enumerate(HISTOGRAM_BUCKETS):
+            if value <= bound:
+                counts[index] += 1
+                break
+        else:
+            counts[-1] += 1
+
+    labels = ['<= %gs' % bound for bound in HISTOGRAM_BUCKETS] + ['> %gs' % HISTOGRAM_BUCKETS[-1]]
+    return list(zip(labels, counts))
+
+
+# Create our plugin based off of CallbackBase from ansible.plugins.callback . Our plugin class must be named
+# CallbackModule.
+#
+# Useful class constants:
+#
+# * CALLBACK_VERSION: The callback API version, 2.0 for the v2_* methods used below.
+# * CALLBACK_TYPE: stdout, notification or aggregate. Only one stdout callback is active at a time, aggregate
+#   callbacks run alongside it.
+# * CALLBACK_NAME: The name used to enable the plugin.
+# * CALLBACK_NEEDS_WHITELIST / CALLBACK_NEEDS_ENABLED: Only run the plugin when it has been enabled in configuration.
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'my_callback_plugin'
+    CALLBACK_NEEDS_WHITELIST = True
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self, display=None):
+        super(CallbackModule, self).__init__(display=display)
+
+        # phase -> list of seconds, one entry per task result that reported the phase
+        self.phases = {}
+        # host -> phase -> list of seconds for that host only
+        self.hosts = {}
+        self.top_hosts = 10
+
+    def set_options(self, *args, **kwargs):
+        super(CallbackModule, self).set_options(*args, **kwargs)
+        self.top_hosts = self.get_option('top_hosts')
+
+    # Record the phase_timings of a task result, including the results of each loop item.
+    def _record(self, result):
+        host = result._host.get_name()
+        task_results = result._result.get('results', [result._result])
+        for task_result in task_results:
+            if not isinstance(task_result, dict):
+                continue
+            timings = task_result.get('phase_timings')
+            if not isinstance(timings, dict):
+                continue
+
+            host_timings = self.hosts.setdefault(host, {})
+            for phase, seconds in timings.items():
+                self.phases.setdefault(phase, []).append(seconds)
+                host_timings.setdefault(phase, []).append(seconds)
+
+    def v2_runner_on_ok(self, result):
+        self._record(result)
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._record(result)
+
+    def v2_playbook_on_stats(self, stats):
+        if not self.phases:
+            return
+
+        self._display.banner('PHASE TIMINGS')
+
+        # Slowest hosts by the total time of all their tasks, with the percentiles of their own task times and the
+        # phase they spent most time in.
+        self._display.display('Slowest hosts:')
+        by_total = sorted(self.hosts.items(), key=lambda item: sum(item[1].get('total', [])), reverse=True)
+        for host, host_timings in by_total[:self.top_hosts]:
+            totals = sorted(host_timings.get('total', []))
+            line = '  %-40s tasks %4d total %8.3fs %s' % (
+                host,
+                len(totals),
+                sum(totals),
+                ' '.join('p%d=%.3fs' % (pct, percentile(totals, pct)) for pct in PERCENTILES)
+            )
+            phases = [phase for phase in host_timings if phase != 'total']
+            if phases:
+                slowest_phase = max(phases, key=lambda phase: sum(host_timings[phase]))
+                line += '  slowest phase %s (%.3fs)' % (slowest_phase, sum(host_timings[slowest_phase]))
+            self._display.display(line)
+
+        # Fleet wide percentiles and histogram of each phase.
+        for phase in sorted(self.phases):
+            values = sorted(self.phases[phase])
+            self._display.display('')
+            self._display.display('%s: n=%d %s max=%.3fs' % (
+                phase,
+                len(values),
+                ' '.join('p%d=%.3fs' % (pct, percentile(values, pct)) for pct in PERCENTILES),
+                values[-1]
+            ))
+
+            buckets = histogram(values)
+            most = max(count for label, count in buckets)
+            for label, count in buckets:
+                if count:
+                    bar = '#' * max(1, int(round(HISTOGRAM_WIDTH * count / float(most))))
+                    self._display.display('  %10s %6d %s' % (label, count, bar))
@@ -157,8 +157,64 @@ options:
         required: true
     new:
         description:
-            - Control to demo if the result of this module is changed or not
+            - Control to demo if the result of this module is changed or not.
+            - Kept for compatibility only, C(changed) now reports drift of the collected facts.
         required: false
+    parallel:
+        description:
+            - Run the independent fact collectors concurrently on threads instead of one after another.
+            - Collectors that depend on facts from other collectors still run after them.
+        required: false
+        type: bool
+        default: false
+    collector_timeout:
+        description:
+            - Seconds each collector may take when I(parallel=true). Collectors still running after this are
+              reported in C(timed_out_collectors) and their facts are left out of the result.
+        required: false
+        type: float
+        default: 10
+    snapshot_path:
+        description:
+            - Path on the target of the compressed snapshot of previously collected facts.
+            - A collector whose cheap signals (boot id, interpreter, user and the mtime of files like /etc/os-release
+              and /etc/passwd) match the snapshot is not run again and its stored facts are reused.
+            - Set to an empty string to disable the snapshot and always collect from scratch.
+        required: false
+        type: str
+        default: ~/.ansible/my_module_facts.json.gz
+    facts:
+        description:
+            - Names or fnmatch patterns (for example C(ansible_distribution*)) of the facts to return in
+              C(ansible_facts) and C(fact_delta).
+            - The projection is applied on the target, so facts that were not asked for are never sent back.
+            - Exact names also limit which collectors run. Any pattern with wildcards runs every collector this module
+              knows about.
+        required: false
+        type: list
+    profile:
+        description:
+            - Run the module under cProfile (and tracemalloc where available) and return the N functions with the
+              most time spent in their own code, and the N source lines that allocated the most memory, in
+              C(profile).
+            - The C(MY_MODULE_PROFILE) environment variable sets the same value, for example through the task's
+              C(environment) keyword.
+            - C(0) disables profiling, which then costs nothing.
+        required: false
+        type: int
+        default: 0
+    output_format:
+        description:
+            - C(json) returns the result as usual.
+            - C(zlib) returns everything but C(changed), C(failed), C(msg) and C(skipped) as zlib compressed, base64
+              encoded JSON in C(compact_result), which is several times smaller for large fact sets. It is meant for
+              callers that decode it, such as my_action_plugin; Ansible itself does not, so C(ansible_facts) are not
+              set as host facts in this format.
+            - Falls back to C(json), with a warning, on Python builds without zlib.
+        required: false
+        type: str
+        choices: [json, zlib]
+        default: json
 
 extends_documentation_fragment:
     - azure
@@ -182,6 +238,14 @@ EXAMPLES = '''
     name: hello world
     new: true
 
+# return just the distribution facts
+- name: Test with a fact projection
+  my_new_test_module:
+    name: hello world
+    facts:
+      - ansible_user_id
+      - ansible_distribution*
+
 # fail the module
 - name: Test failure of the module
   my_new_test_module:
@@ -238,6 +302,59 @@ original_message:
     type: str
 message:
     description: The output message that the sample module generates
+timed_out_collectors:
+    description: Names of the fact collectors that did not finish within collector_timeout
+    returned: when parallel is true
+    type: list
+    sample: ['distribution']
+fact_delta:
+    description: Facts that changed or disappeared since the previous snapshot of the same collector
+    returned: when snapshot_path is set
+    type: complex
+    contains:
+        changed:
+            description: The new value of every fact that was added or changed
+            type: dict
+            sample: {'ansible_user_id': 'deploy'}
+        removed:
+            description: Names of the facts that are no longer reported
+            type: list
+            sample: []
+phase_timings:
+    description:
+        - Seconds spent in each phase of the module (resolve, snapshot_load, collect, snapshot_save, total) and in
+          each fact collector (collector.<name>).
+    returned: always
+    type: dict
+    sample: {'collect': 0.012, 'collector.user': 0.011, 'total': 0.02}
+profile:
+    description:
+        - The hottest functions as [function, calls, own seconds, cumulative seconds], sorted by own seconds.
+        - Current and peak traced memory, and the top allocating lines as [line, bytes, blocks]. Left out on Python 2.
+    returned: when profile or MY_MODULE_PROFILE is set
+    type: complex
+    contains:
+        functions:
+            description: The hottest functions
+            type: list
+            sample: [['ansible/module_utils/facts/system/user.py:27(collect)', 1, 0.0102, 0.0113]]
+        memory:
+            description: Traced memory in bytes and the top allocating lines
+            type: dict
+            sample: {'current_bytes': 18234, 'peak_bytes': 90412, 'top': [['json/decoder.py:353', 4120, 52]]}
+compact_result:
+    description: The rest of the result, compressed
+    returned: when output_format is zlib
+    type: complex
+    contains:
+        format:
+            description: How data is encoded
+            type: str
+            sample: zlib
+        data:
+            description: Base64 of the zlib compressed JSON of the result
+            type: str
+            sample: eJyrVkrOzytJzSsJqSxIVbJSMjQxMDIwMjCoBQBi5Qa+
 '''
 
 # Formatting options
@@ -261,6 +378,25 @@ message:
 # 
 # Examples can be found by searching for `extends_documentation_fragment` under the Ansible source tree.
 
+# Standard library helpers for parallel fact collection and the on-host fact snapshot
+import base64
+import fnmatch
+import gzip
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# zlib is an optional part of a Python build; without it output_format=zlib falls back to plain JSON.
+try:
+    import zlib
+except ImportError:
+    zlib = None
+
 # Ansible modules can only access the ansible.module_utils API. If you need to execute other Ansible modules, this can
 # only be done from an Ansible Action Plugin.
 #
@@ -268,16 +404,361 @@ message:
 from ansible.module_utils.basic import AnsibleModule
 
 # Ansible facts
-from ansible.module_utils.facts.namespace import PrefixFactNamespace
-from ansible.module_utils.facts import ansible_collector, default_collectors
+#
+# Only the collector framework is imported here, and the collectors themselves are loaded by name through
+# COLLECTOR_LOADERS below. Importing anything from ansible.module_utils.facts runs the package's __init__ though,
+# which imports facts.compat and through it default_collectors and every collector Ansible ships. So the package is
+# registered without running its __init__ first, and the framework pieces are imported from their own modules.
+#
+# This trims what the target imports, not the payload: AnsiballZ's import scan always packs (and follows the imports
+# of) the __init__ of every package a module_utils file lives in. On ansible-core 2.19 it loads 57 module_utils files
+# instead of 125 and saves about 35 ms (20%) of import time on every run, which is why it is kept. The price is that
+# in a process that imports my_module (the benchmarks, for example) the package stays bare: names its __init__ would
+# have provided, such as ansible_facts, have to be imported from facts.compat instead.
+def _register_bare_package(name):
+    if name in sys.modules:
+        return
+    try:
+        import importlib.util
+    except ImportError:
+        # Python 2 imports the package, __init__ included, as usual.
+        return
+    spec = importlib.util.find_spec(name)
+    if spec is not None:
+        sys.modules[name] = importlib.util.module_from_spec(spec)
+
+
+_register_bare_package('ansible.module_utils.facts')
+from ansible.module_utils.facts.namespace import PrefixFactNamespace  # noqa: E402
+from ansible.module_utils.facts.ansible_collector import get_ansible_collector  # noqa: E402
+
+# The facts this module reads from the collectors.
+REQUIRED_FACTS = ('ansible_user_id',)
+
+
+# Loaders for the fact collectors this module can use, keyed by their gather_subset name.
+#
+# Each import sits inside a function so it only runs on the target when that collector is actually needed. They are
+# still plain import statements though, so AnsiballZ's static scan of the module finds them and packs just these
+# files (rather than all of default_collectors) into the payload.
+def _load_distribution_collector():
+    from ansible.module_utils.facts.system.distribution import DistributionFactCollector
+    return DistributionFactCollector
+
+
+def _load_platform_collector():
+    from ansible.module_utils.facts.system.platform import PlatformFactCollector
+    return PlatformFactCollector
+
+
+def _load_user_collector():
+    from ansible.module_utils.facts.system.user import UserFactCollector
+    return UserFactCollector
+
+
+COLLECTOR_LOADERS = dict(
+    distribution=_load_distribution_collector,
+    platform=_load_platform_collector,
+    user=_load_user_collector
+)
+
+
+# Load the collector classes for names, plus any collectors they list in required_facts.
+def load_collectors(names):
+    collector_classes = []
+    pending = list(names)
+    while pending:
+        name = pending.pop(0)
+        collector_class = COLLECTOR_LOADERS[name]()
+        if collector_class in collector_classes:
+            continue
+        collector_classes.append(collector_class)
+        pending.extend(dep for dep in collector_class.required_facts if dep in COLLECTOR_LOADERS)
+    return collector_classes
+
+
+# Work out the smallest gather subset that still produces every fact in fact_keys.
+#
+# Each collector class has a name (the value accepted by gather_subset) and a set of _fact_ids it produces, without
+# the namespace prefix. The collector whose name starts the key (user for user_id) is tried first so normally only
+# that one collector gets loaded. Returns a sorted list of collector names, or None if a key is not produced by any
+# of the COLLECTOR_LOADERS collectors.
+def resolve_gather_subset(fact_keys, prefix='ansible_'):
+    names = set()
+    for key in fact_keys:
+        short_key = key[len(prefix):] if key.startswith(prefix) else key
+        candidates = sorted(COLLECTOR_LOADERS, key=lambda name: not short_key.startswith(name))
+        for name in candidates:
+            collector_class = COLLECTOR_LOADERS[name]()
+            if short_key == collector_class.name or short_key in collector_class._fact_ids:
+                names.add(collector_class.name)
+                break
+        else:
+            return None
+    return sorted(names)
+
+# Add the wall clock time spent in the block to timings[name]. The module returns timings as phase_timings so that
+# my_callback_plugin can aggregate them across hosts.
+@contextmanager
+def timed(timings, name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.time() - start
+
+
+# Profiling, only used when the profile option or MY_MODULE_PROFILE asks for it. The profiling modules are imported
+# here rather than at the top so a normal run does not even pay for the imports.
+#
+# Returns (profiler, started_tracing). If tracemalloc was already tracing (PYTHONTRACEMALLOC, or a caller importing
+# the module) it is left to whoever started it.
+def start_profile():
+    import cProfile
+    import pstats  # noqa: F401, imported before tracing starts so its import is not reported
+    try:
+        import tracemalloc
+    except ImportError:
+        # Python 2 has no tracemalloc, only function timings are reported there.
+        tracemalloc = None
+    started_tracing = tracemalloc is not None and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler, started_tracing
+
+
+# Shorten a source path to the part that identifies it: from ansible/ on for module_utils files (which live in a
+# random AnsiballZ directory on the target), or the last two path components otherwise.
+def short_path(path):
+    index = path.rfind('ansible/module_utils/')
+    if index != -1:
+        return path[index:]
+    return '/'.join(path.split(os.sep)[-2:])
+
+
+# Stop the profile start_profile returned and return the compact profile report for the top entries. tracemalloc is
+# only stopped if start_profile started it; otherwise the memory reported includes what was traced before the run.
+def stop_profile(profile, top):
+    profiler, started_tracing = profile
+    profiler.disable()
+    import pstats
+    stats = pstats.Stats(profiler).stats
+    hottest = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:top]
+    report = dict(functions=[
+        ['%s:%d(%s)' % (short_path(path), line, name), calls, round(own, 6), round(cumulative, 6)]
+        for (path, line, name), (primitive_calls, calls, own, cumulative, callers) in hottest
+    ])
+
+    try:
+        import tracemalloc
+    except ImportError:
+        return report
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        # Leave out what the profiler itself allocated.
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, module.__file__) for module in (tracemalloc, pstats, sys.modules['cProfile'])
+        ])
+        lines = snapshot.statistics('lineno')[:top]
+        if started_tracing:
+            tracemalloc.stop()
+        report['memory'] = dict(
+            current_bytes=current,
+            peak_bytes=peak,
+            top=[
+                ['%s:%d' % (short_path(stat.traceback[0].filename), stat.traceback[0].lineno), stat.size, stat.count]
+                for stat in lines
+            ]
+        )
+    return report
+
+
+# Result keys that stay in the plain JSON with output_format=zlib, as Ansible reads them before any caller gets to
+# decode the result.
+PLAIN_RESULT_KEYS = ('changed', 'failed', 'msg', 'skipped')
+
+
+# Pack result for output_format=zlib: every key but PLAIN_RESULT_KEYS goes into compact_result as zlib compressed,
+# base64 encoded JSON.
+def compact_result(result):
+    packed = dict((key, value) for key, value in result.items() if key not in PLAIN_RESULT_KEYS)
+    data = zlib.compress(json.dumps(packed, separators=(',', ':')).encode('utf-8'), 6)
+
+    compact = dict((key, result[key]) for key in PLAIN_RESULT_KEYS if key in result)
+    compact['compact_result'] = dict(format='zlib', data=base64.b64encode(data).decode('ascii'))
+    return compact
+
+
+# Whether a facts pattern uses fnmatch wildcards rather than naming a single fact.
+def is_glob(pattern):
+    return any(char in pattern for char in '*?[')
+
+
+# Compile the facts patterns into a single regular expression, so each fact name is matched once however many
+# patterns were given. Returns None when no projection was asked for.
+def compile_projection(patterns):
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:%s)' % fnmatch.translate(pattern) for pattern in patterns))
+
+
+def project_facts(facts, projection):
+    return dict((key, value) for key, value in facts.items() if projection.match(key))
+
+
+# Files whose modification time changes when the facts of a collector may have changed. Together with the boot id,
+# the host name, the interpreter and the effective user they make up the signature stored next to each collector in
+# the snapshot. The host name catches a transient rename (hostname NAME), /etc/hostname and /etc/hosts a persistent
+# one (hostnamectl set-hostname) and changes to the fqdn and domain.
+SNAPSHOT_SIGNALS = dict(
+    distribution=('/etc/os-release', '/usr/lib/os-release', '/etc/lsb-release', '/etc/system-release',
+                  '/etc/debian_version'),
+    platform=('/etc/hostname', '/etc/hosts'),
+    user=('/etc/passwd', '/etc/group')
+)
+
+
+def read_boot_id():
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+# The signature of a collector, or None for collectors without SNAPSHOT_SIGNALS which always have to run.
+def snapshot_signature(name, boot_id):
+    if name not in SNAPSHOT_SIGNALS:
+        return None
+
+    mtimes = []
+    for path in SNAPSHOT_SIGNALS[name]:
+        try:
+            mtimes.append(os.stat(path).st_mtime)
+        except OSError:
+            mtimes.append(None)
+    return [boot_id, os.uname()[1], sys.executable, sys.version, os.geteuid(), mtimes]
+
+
+# The snapshot is a gzipped JSON dict of collector name to its signature and facts. A missing or unreadable snapshot
+# is treated as empty, so the worst case is collecting from scratch.
+def load_snapshot(path):
+    try:
+        with gzip.open(os.path.expanduser(path), 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+# Write to a temporary file next to the snapshot and rename it over the old one, so a concurrent run never reads a
+# half written snapshot.
+def save_snapshot(path, snapshot):
+    path = os.path.expanduser(path)
+    snapshot_dir = os.path.dirname(path)
+    if snapshot_dir and not os.path.isdir(snapshot_dir):
+        os.makedirs(snapshot_dir)
+
+    fd, tmp_path = tempfile.mkstemp(dir=snapshot_dir or '.', prefix='.my_module_facts')
+    try:
+        with os.fdopen(fd, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+                f.write(json.dumps(snapshot, separators=(',', ':'), sort_keys=True).encode('utf-8'))
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+# Run the collectors of fact_collector one after another, the same way AnsibleFactCollector.collect does, but keep
+# the facts of each collector apart so they can be stored in the snapshot. A collector that raises is left out of
+# the returned dict. The time taken by each collector is added to timings as collector.<name>.
+def collect_serial(fact_collector, module, timings):
+    results = {}
+    collected_facts = {}
+    for collector in fact_collector.collectors:
+        try:
+            with timed(timings, 'collector.%s' % collector.name):
+                results[collector.name] = \
+                    collector.collect_with_namespace(module=module, collected_facts=collected_facts)
+        except Exception as e:
+            module.warn('fact collector %s failed: %s' % (collector.name, e))
+            continue
+        collected_facts.update(results[collector.name])
+    return results
+
+
+# Run the collectors of fact_collector concurrently, each on its own thread.
+#
+# Collectors without required_facts do not depend on each other so they all start at once; collectors that do need
+# facts from others run afterwards, with everything collected so far. Every collector gets timeout seconds, so the
+# total time is set by the slowest collector rather than the sum of all of them.
+#
+# Collector threads are daemon threads: one that misses its deadline is left behind and dies with the module process
+# once exit_json is called. Returns the facts of each collector that finished (as collect_serial does) and the names
+# of the collectors that timed out. Collectors that finish add their time to timings as collector.<name>.
+def collect_parallel(fact_collector, module, timeout, timings):
+    def collect_one(collector, collected_facts, results):
+        start = time.time()
+        try:
+            results[collector.name] = collector.collect_with_namespace(module=module, collected_facts=collected_facts)
+            durations[collector.name] = time.time() - start
+        except Exception as e:
+            module.warn('fact collector %s failed: %s' % (collector.name, e))
+
+    def run_wave(collectors, collected_facts):
+        results = {}
+        threads = []
+        for collector in collectors:
+            thread = threading.Thread(target=collect_one, args=(collector, dict(collected_facts), results))
+            thread.daemon = True
+            thread.start()
+            threads.append((collector, thread))
+
+        deadline = time.time() + timeout
+        for collector, thread in threads:
+            thread.join(max(0, deadline - time.time()))
+            if thread.is_alive():
+                timed_out.append(collector.name)
+            elif collector.name in results:
+                finished[collector.name] = results[collector.name]
+                timings['collector.%s' % collector.name] = durations[collector.name]
+                # Merge in collector order so results do not depend on which thread finished first.
+                collected_facts.update(finished[collector.name])
+
+    timed_out = []
+    finished = {}
+    durations = {}
+    collected_facts = {}
+    independent = [c for c in fact_collector.collectors if not getattr(c, 'required_facts', None)]
+    dependent = [c for c in fact_collector.collectors if getattr(c, 'required_facts', None)]
+
+    run_wave(independent, collected_facts)
+    for collector in dependent:
+        run_wave([collector], collected_facts)
+
+    return finished, timed_out
+
 
 # Ensure module code meets (Development Guidelines)[https://docs.ansible.com/ansible/2.4/dev_guide/developing_modules_checklist.html]
 def run_module():
+    # Per phase (and per collector) timings, returned as phase_timings.
+    timings = {}
+    run_start = time.time()
+
     # define the available arguments/parameters that a user can pass to
     # the module
     module_args = dict(
         name=dict(type='str', required=True),
-        new=dict(type='bool', required=False, default=False)
+        new=dict(type='bool', required=False, default=False),
+        parallel=dict(type='bool', required=False, default=False),
+        collector_timeout=dict(type='float', required=False, default=10),
+        snapshot_path=dict(type='str', required=False, default='~/.ansible/my_module_facts.json.gz'),
+        facts=dict(type='list', required=False, default=None),
+        profile=dict(type='int', required=False, default=0),
+        output_format=dict(type='str', required=False, default='json', choices=['json', 'zlib'])
     )
 
     # seed the result dict in the object
@@ -291,19 +772,6 @@ def run_module():
         ansible_facts=dict()
     )
 
-    # initialize the Ansible facts collector.
-    # Collector classes define the high level categories of collectors.
-    # Filter spec sets the variable fact regex filter.
-    # Gather subset is the subset of facts to gather.
-    # Minimal gather subset is the subset of facts to always gather regardless of the gather subset filter.
-    # namespace is a fact namespace (like ohai or ansible).
-    # prefix is the string to append the facts collected.
-    all_collector_classes = default_collectors.collectors
-    filter_spec = '*'
-    gather_subset = ['distribution', 'platform', 'user']
-    minimal_gather_subset = gather_subset
-    namespace = PrefixFactNamespace(namespace_name='ansible', prefix='ansible_')
-
     # the AnsibleModule object will be our abstraction working with Ansible
     # this includes instantiation, a couple of common attr would be the
     # args/params passed to the execution, as well as if the module
@@ -317,23 +785,131 @@ def run_module():
     # if the user is working with this module in only check mode we do not
     # want to make any changes to the environment, just return the current
     # state with no modifications
+    compact = module.params['output_format'] == 'zlib'
+    if compact and zlib is None:
+        module.warn('zlib is not available on this host, returning plain JSON')
+        compact = False
+
     if module.check_mode:
-        module.exit_json(**result)
+        module.exit_json(**(compact_result(result) if compact else result))
+
+    # Profile the rest of the run when asked to. With profiling off this is the only cost.
+    profile_top = module.params['profile']
+    if not profile_top and os.environ.get('MY_MODULE_PROFILE'):
+        try:
+            profile_top = int(os.environ['MY_MODULE_PROFILE'])
+        except ValueError:
+            module.fail_json(msg='MY_MODULE_PROFILE must be a number of entries to report', **result)
+    profile = start_profile() if profile_top > 0 else None
+
+    # initialize the Ansible facts collector.
+    # Collector classes define the high level categories of collectors.
+    # Gather subset is the subset of facts to gather.
+    # Minimal gather subset is the subset of facts to always gather regardless of the gather subset filter.
+    # namespace is a fact namespace (like ohai or ansible).
+    # prefix is the string to append the facts collected.
+    #
+    # Only the collectors producing REQUIRED_FACTS and the fact names asked for with the facts option are loaded and
+    # run, and the minimal subset is left empty so nothing else gets collected on the target. Glob patterns can match
+    # facts of any collector, so they fall back to running all of them. No filter_spec is passed: collect_serial and
+    # collect_parallel run the collectors themselves, so the facts option is applied by the projection below.
+    projection = compile_projection(module.params['facts'])
+    fact_keys = list(REQUIRED_FACTS) + list(module.params['facts'] or [])
+    with timed(timings, 'resolve'):
+        gather_subset = None
+        if not any(is_glob(key) for key in fact_keys):
+            gather_subset = resolve_gather_subset(fact_keys)
+        if gather_subset is None:
+            gather_subset = ['distribution', 'platform', 'user']
+        collector_names = [collector_class.name for collector_class in load_collectors(gather_subset)]
+    minimal_gather_subset = frozenset()
+    namespace = PrefixFactNamespace(namespace_name='ansible', prefix='ansible_')
+
+    # Work out which collectors actually have to run. A collector whose signature still matches the one stored in the
+    # on-host snapshot is skipped and its stored facts are reused.
+    snapshot_path = module.params['snapshot_path']
+    with timed(timings, 'snapshot_load'):
+        snapshot = load_snapshot(snapshot_path) if snapshot_path else {}
+        boot_id = read_boot_id()
+        signatures = dict((name, snapshot_signature(name, boot_id)) for name in collector_names)
+        stale = [
+            name for name in collector_names
+            if signatures[name] is None or snapshot.get(name, {}).get('signature') != signatures[name]
+        ]
 
     # Create our fact collector instance and use the module instance to
     # collect the facts using the Ansible facts modules.
-    fact_collector = \
-        ansible_collector.get_ansible_collector(all_collector_classes=all_collector_classes,
-                                                filter_spec=filter_spec,
-                                                namespace=namespace,
-                                                gather_subset=gather_subset,
-                                                minimal_gather_subset=minimal_gather_subset)
+    collected = {}
+    if stale:
+        fact_collector = \
+            get_ansible_collector(all_collector_classes=load_collectors(stale),
+                                  namespace=namespace,
+                                  gather_subset=stale,
+                                  minimal_gather_subset=minimal_gather_subset)
+
+        with timed(timings, 'collect'):
+            if module.params['parallel']:
+                collected, result['timed_out_collectors'] = \
+                    collect_parallel(fact_collector, module, module.params['collector_timeout'], timings)
+            else:
+                collected = collect_serial(fact_collector, module, timings)
+
+    # Merge fresh and reused facts and work out what drifted since the last snapshot. Only the entries of collectors
+    # whose signature still matches are reused. A collector that had to run but timed out or failed is left out of
+    # the result, even if the snapshot has an older entry for it: that entry is stale. The entry itself is kept, so
+    # the next run that completes still reports drift against it. A collector seen for the first time sets the
+    # baseline and does not count as drift.
+    facts_dict = {}
+    delta = dict(changed={}, removed=[])
+    for name in collector_names:
+        previous = snapshot.get(name)
+        if name not in collected:
+            if previous is not None and name not in stale:
+                facts_dict.update(previous['facts'])
+            continue
 
-    facts_dict = fact_collector.collect(module=module)
+        # Round trip through JSON so values compare the same way they were stored (tuples become lists).
+        facts = json.loads(json.dumps(collected[name]))
+        if previous is not None:
+            delta['changed'].update(
+                (key, value) for key, value in facts.items() if previous['facts'].get(key) != value
+            )
+            delta['removed'].extend(key for key in previous['facts'] if key not in facts)
+        snapshot[name] = dict(signature=signatures[name], facts=facts)
+        facts_dict.update(facts)
+
+    # Apply the facts projection on the target, so only the requested facts (and their drift) are sent back.
+    if projection is not None:
+        result['ansible_facts'].update(project_facts(facts_dict, projection))
+        delta = dict(
+            changed=project_facts(delta['changed'], projection),
+            removed=[key for key in delta['removed'] if projection.match(key)]
+        )
+
+    if snapshot_path:
+        result['fact_delta'] = delta
+        result['changed'] = bool(delta['changed'] or delta['removed'])
+        if collected:
+            try:
+                with timed(timings, 'snapshot_save'):
+                    save_snapshot(snapshot_path, snapshot)
+            except (IOError, OSError) as e:
+                module.warn('could not save fact snapshot to %s: %s' % (snapshot_path, e))
 
     # Update the ansible_facts in our return struct so that its available to other tasks
-    result['ansible_facts']['my_custom_fact'] = facts_dict['ansible_user_id']
- 
+    # (a timed out user collector leaves it unset).
+    if 'ansible_user_id' in facts_dict:
+        result['ansible_facts']['my_custom_fact'] = facts_dict['ansible_user_id']
+
+    if profile is not None:
+        result['profile'] = stop_profile(profile, profile_top)
+
+    timings['total'] = time.time() - run_start
+    result['phase_timings'] = timings
+
+    if compact:
+        result = compact_result(result)
+
     # during the execution of the module, if there is an exception or a
     # conditional state that effectively causes a failure, run
     # AnsibleModule.fail_json() to pass in the message and the result
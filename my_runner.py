@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# Run my_module across a list of hosts concurrently, without a play, and stream one JSON line per host as it
+# finishes.
+#
+# Meant for quick fact sweeps: there is no inventory parsing beyond host names, no templating and no action plugin,
+# each host is one execution of my_module.py with the same module arguments. Hosts go through a bounded pool of
+# --forks workers (threads by default, each worker mostly waits on its child process, or processes with
+# --pool process), so a sweep takes about as long as its slowest host rather than the sum of all of them.
+#
+# How the module reaches a host is up to the connection (--connection):
+#
+# * local runs `python my_module.py args.json` as a subprocess on this machine, whatever the host name. It is the
+#   stand-in used to try the runner, or to benchmark it, without any remote host.
+# * ssh pipes my_module.py into the interpreter on the host (ssh HOST python3 - ARGS), with the module arguments as
+#   a JSON argument. Nothing is copied to the host, but Ansible must be importable by the remote interpreter.
+#
+# Every line written is a JSON object with host, elapsed (seconds), failed and either the module result or, when
+# the host could not be run or did not return JSON, msg, rc and stderr. Results returned with output_format=zlib are
+# decoded before being written. A summary goes to stderr at the end, and the exit code is 2 if any host failed.
+#
+# Usage:
+#
+#   python my_runner.py web1 web2 db1 --connection local --forks 20
+#   python my_runner.py --inventory hosts --connection ssh --forks 50 --timeout 60 > facts.ndjson
+#   python my_runner.py --inventory hosts --module-args '{"name": "sweep", "facts": ["ansible_distribution*"]}'
+#
+# Requires Ansible to be importable by the interpreter running my_module.py.
+
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+from shlex import quote as shlex_quote
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+MODULE_PATH = os.path.join(REPO_DIR, 'my_module.py')
+
+# my_module requires name, so the default arguments set it.
+DEFAULT_MODULE_ARGS = '{"name": "my_runner"}'
+
+
+class RunError(Exception):
+    pass
+
+
+# Run command, feeding it in_data, and return (rc, stdout, stderr). Raises RunError when it cannot be started or
+# runs for longer than timeout seconds.
+def execute(command, in_data, timeout):
+    try:
+        # In a session of its own so a timeout kills whatever the command started too, which would otherwise keep
+        # its output open and the worker waiting.
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   start_new_session=True)
+    except OSError as e:
+        raise RunError('cannot run %s: %s' % (command[0], e.strerror))
+    try:
+        stdout, stderr = process.communicate(in_data, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.communicate()
+        raise RunError('timed out after %ss' % timeout)
+    return process.returncode, stdout.decode('utf-8', 'replace'), stderr.decode('utf-8', 'replace')
+
+
+# The connections: each runs my_module.py for one host and returns (rc, stdout, stderr), or raises RunError when
+# the module could not be run at all.
+def run_local(host, args):
+    return execute([args.python or sys.executable, MODULE_PATH, args.args_file], None, args.timeout)
+
+
+def run_ssh(host, args):
+    with open(MODULE_PATH, 'rb') as f:
+        module_source = f.read()
+    remote_command = '%s - %s' % (args.python or 'python3', shlex_quote(args.args_json))
+    command = ['ssh', '-o', 'BatchMode=yes'] + args.ssh_args + [host, remote_command]
+    rc, stdout, stderr = execute(command, module_source, args.timeout)
+    # 255 is ssh's own exit code: the host was not reached, the module never ran.
+    if rc == 255:
+        raise RunError(stderr.strip() or 'ssh failed')
+    return rc, stdout, stderr
+
+
+CONNECTIONS = dict(local=run_local, ssh=run_ssh)
+
+
+# The module's JSON result from its stdout, skipping anything printed before it (motd, interpreter warnings).
+def parse_result(stdout):
+    for line in stdout.splitlines():
+        if line.lstrip().startswith('{'):
+            try:
+                return json.loads(line)
+            except ValueError:
+                pass
+    return None
+
+
+# Decoding output_format=zlib results needs the action plugin's decoder, which needs Ansible, so it is only loaded
+# once a compact result comes back.
+decode_compact_result = None
+
+
+def decode_result(result):
+    global decode_compact_result
+    if 'compact_result' not in result:
+        return result
+    if decode_compact_result is None:
+        spec = importlib.util.spec_from_file_location('my_action_plugin', os.path.join(REPO_DIR, 'my_action_plugin.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        decode_compact_result = module.decode_compact_result
+    return decode_compact_result(result)
+
+
+# Set in each worker by init_worker.
+ARGS = None
+
+
+def init_worker(args):
+    global ARGS
+    ARGS = args
+
+
+# Run the module for one host. Returns the line to write for it.
+def run_host(host):
+    start = time.time()
+    line = dict(host=host)
+    try:
+        rc, stdout, stderr = CONNECTIONS[ARGS.connection](host, ARGS)
+    except RunError as e:
+        line.update(failed=True, unreachable=True, msg=str(e))
+    else:
+        result = parse_result(stdout)
+        if result is None:
+            line.update(failed=True, msg='module did not return JSON', rc=rc, stderr=stderr[-2000:])
+        else:
+            result = decode_result(result)
+            line.update(failed=bool(result.get('failed')) or rc != 0, result=result)
+    line['elapsed'] = round(time.time() - start, 3)
+    return line
+
+
+# Host names from an inventory file: the first word of every line, skipping blank lines, comments and [group]
+# headings, so a plain list of hosts and a simple INI inventory both work.
+def read_inventory(path):
+    hosts = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith(('#', ';', '[')):
+                continue
+            hosts.append(line.split()[0])
+    return hosts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run my_module across hosts and stream the results as JSON lines')
+    parser.add_argument('hosts', nargs='*', help='hosts to run on')
+    parser.add_argument('--inventory', '-i', help='file with one host per line')
+    parser.add_argument('--connection', '-c', choices=sorted(CONNECTIONS), default='local')
+    parser.add_argument('--module-args', '-a', default=DEFAULT_MODULE_ARGS,
+                        help='module arguments as a JSON object (default: %(default)s)')
+    parser.add_argument('--forks', '-f', type=int, default=20, help='hosts run at the same time')
+    parser.add_argument('--pool', choices=('thread', 'process'), default='thread', help='kind of worker pool')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds before a host is given up on')
+    parser.add_argument('--python', help='interpreter running the module (default: this one locally, python3 '
+                                         'over ssh)')
+    parser.add_argument('--ssh-arg', dest='ssh_args', action='append', default=[],
+                        help='extra argument for ssh (repeatable)')
+    args = parser.parse_args()
+
+    hosts = list(args.hosts)
+    if args.inventory:
+        hosts.extend(read_inventory(args.inventory))
+    if not hosts:
+        parser.error('no hosts given')
+
+    try:
+        module_args = json.loads(args.module_args)
+    except ValueError as e:
+        parser.error('--module-args is not valid JSON: %s' % e)
+    args.args_json = json.dumps(dict(ANSIBLE_MODULE_ARGS=module_args))
+
+    # The local connection hands the arguments over in a file, written once for all hosts.
+    args_dir = tempfile.mkdtemp(prefix='my-runner-')
+    args.args_file = os.path.join(args_dir, 'args.json')
+    with open(args.args_file, 'w') as f:
+        f.write(args.args_json)
+
+    pool_class = multiprocessing.Pool if args.pool == 'process' else ThreadPool
+    pool = pool_class(max(1, min(args.forks, len(hosts))), initializer=init_worker, initargs=(args,))
+
+    failures = 0
+    slowest = 0.0
+    start = time.time()
+    try:
+        for line in pool.imap_unordered(run_host, hosts):
+            failures += line['failed']
+            slowest = max(slowest, line['elapsed'])
+            sys.stdout.write(json.dumps(line, sort_keys=True) + '\n')
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(args_dir, ignore_errors=True)
+
+    print('%d hosts, %d failed, %.2fs (slowest host %.2fs)' % (len(hosts), failures, time.time() - start, slowest),
+          file=sys.stderr)
+    sys.exit(2 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+# Tests for compose_expander: extends merging, env files, cycles, file formats and the cache.
+#
+# Run with: python -m pytest tests
+
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, REPO_DIR)
+import compose_expander as expander  # noqa: E402
+
+
+def write(directory, name, text):
+    path = directory / name
+    path.write_text(text)
+    return str(path)
+
+
+def expand(path, names=None, compose=None):
+    compose = compose or expander.ComposeExpander()
+    return dict(compose.expand(path, names))
+
+
+def test_extends_merges_by_option(tmp_path):
+    path = write(tmp_path, 'docker-compose.yml', '''
+version: "2"
+services:
+  base:
+    image: app:1
+    command: serve
+    ports: ["80:80"]
+    dns: 8.8.8.8
+    environment:
+      LEVEL: info
+      REGION: eu
+    volumes:
+      - ./data:/data
+      - /logs:/var/log
+    depends_on: [db]
+  web:
+    extends: base
+    command: serve --debug
+    ports: ["80:80", "443:443"]
+    dns: [1.1.1.1]
+    environment:
+      - LEVEL=debug
+    volumes:
+      - /other:/data
+  db:
+    image: postgres
+''')
+    web = expand(path, ['web'])['web']
+    assert web['image'] == 'app:1'
+    assert web['command'] == 'serve --debug'
+    assert web['ports'] == ['80:80', '443:443']
+    assert web['dns'] == ['8.8.8.8', '1.1.1.1']
+    assert web['environment'] == dict(LEVEL='debug', REGION='eu')
+    assert web['volumes'] == ['/other:/data', '/logs:/var/log']
+    assert 'depends_on' not in web
+
+
+def test_extends_another_file_resolves_paths_against_it(tmp_path):
+    (tmp_path / 'common').mkdir()
+    write(tmp_path / 'common', 'base.yml', 'app:\n  build: .\n  env_file: app.env\n')
+    write(tmp_path / 'common', 'app.env', 'FROM_BASE=1\n')
+    path = write(tmp_path, 'docker-compose.yml', '''
+web:
+  extends:
+    file: common/base.yml
+    service: app
+''')
+    web = expand(path)['web']
+    assert web['build'] == dict(context=str(tmp_path / 'common'))
+    assert web['environment'] == dict(FROM_BASE='1')
+
+
+def test_env_file_precedence(tmp_path):
+    write(tmp_path, 'base.env', 'A=base\nB=base\nC=base\n# a comment\n\nEMPTY\n')
+    write(tmp_path, 'web.env', 'B=web\n')
+    path = write(tmp_path, 'docker-compose.yml', '''
+services:
+  base:
+    image: app
+    env_file: base.env
+  web:
+    extends: base
+    env_file: [web.env]
+    environment:
+      C: environment
+''')
+    web = expand(path, ['web'])['web']
+    # Later env files override earlier ones and environment overrides them all.
+    assert web['environment'] == dict(A='base', B='web', C='environment', EMPTY=None)
+    assert 'env_file' not in web
+
+
+def test_extends_cycle(tmp_path):
+    path = write(tmp_path, 'docker-compose.yml', '''
+services:
+  a:
+    extends: b
+  b:
+    extends: a
+''')
+    with pytest.raises(expander.ComposeError) as error:
+        expand(path, ['a'])
+    assert 'extends cycle' in str(error.value)
+
+
+def test_missing_service(tmp_path):
+    path = write(tmp_path, 'docker-compose.yml', 'services:\n  web:\n    extends: nope\n')
+    with pytest.raises(expander.ComposeError):
+        expand(path)
+
+
+@pytest.mark.parametrize('text', [
+    'version: "3.8"\nservices:\n  web:\n    image: app\n',
+    'services:\n  web:\n    image: app\n',
+    'web:\n  image: app\n',
+])
+def test_file_formats(tmp_path, text):
+    path = write(tmp_path, 'docker-compose.yml', text)
+    assert expand(path) == dict(web=dict(image='app'))
+
+
+def test_cache_reuses_unchanged_services(tmp_path):
+    write(tmp_path, 'web.env', 'A=1\n')
+    path = write(tmp_path, 'docker-compose.yml', '''
+services:
+  base:
+    image: app
+  web:
+    extends: base
+    env_file: web.env
+  worker:
+    image: worker
+''')
+    cache = str(tmp_path / 'cache.json')
+
+    first = expander.ComposeExpander()
+    expand(path, compose=first)
+    first.save_cache(cache)
+    assert first.stats['services_expanded'] == 3
+
+    second = expander.ComposeExpander()
+    second.load_cache(cache)
+    assert expand(path, compose=second) == expand(path)
+    assert second.stats['services_expanded'] == 0
+    assert second.stats['services_reused'] == 3
+    assert second.stats['files_read'] == 0
+
+    # An edit to the env file only expands the service using it again.
+    write(tmp_path, 'web.env', 'A=22\n')
+    third = expander.ComposeExpander()
+    third.load_cache(cache)
+    services = expand(path, compose=third)
+    assert services['web']['environment'] == dict(A='22')
+    assert third.stats['services_expanded'] == 1
+    assert third.stats['services_reused'] == 2
+
+
+def test_cache_of_another_version_is_ignored(tmp_path):
+    cache = tmp_path / 'cache.json'
+    cache.write_text('{"version": 0, "files": {"x": 1}, "resolved": {"y": 2}}')
+    compose = expander.ComposeExpander()
+    compose.load_cache(str(cache))
+    assert compose.files == {} and compose.resolved == {}
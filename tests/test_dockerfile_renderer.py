@@ -0,0 +1,223 @@
+# Tests for dockerfile_renderer: parsing, variable substitution, cache keys and the --optimize rewrite.
+#
+# Run with: python -m pytest tests
+
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, REPO_DIR)
+import dockerfile_renderer as renderer  # noqa: E402
+
+
+@pytest.fixture
+def context(tmp_path):
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'src' / 'app.py').write_text('print(1)\n')
+    (tmp_path / 'requirements.txt').write_text('six\n')
+    return tmp_path
+
+
+def plan_text(text, context, build_args=None):
+    escape, instructions = renderer.parse_dockerfile(text)
+    return renderer.plan(instructions, escape, renderer.ContextHasher(str(context)), build_args or {})
+
+
+def keys(steps):
+    return [step.key for step in steps]
+
+
+def test_parse_joins_continuations_and_skips_comments():
+    escape, instructions = renderer.parse_dockerfile(
+        'FROM alpine\n'
+        '\n'
+        '# a comment\n'
+        'RUN apk add \\\n'
+        '    # inside the continuation\n'
+        '    curl\n'
+        'CMD ["sh"]\n'
+    )
+    assert escape == '\\'
+    assert [(i.keyword, i.args, i.line) for i in instructions] == [
+        ('FROM', 'alpine', 1),
+        ('RUN', 'apk add     curl', 4),
+        ('CMD', '["sh"]', 7),
+    ]
+
+
+def test_parse_escape_directive():
+    escape, instructions = renderer.parse_dockerfile('# escape=`\nFROM windows\nRUN dir `\n  c:\\\n')
+    assert escape == '`'
+    assert instructions[1].args == 'dir   c:\\'
+
+
+def test_parse_directive_only_at_the_top():
+    escape, instructions = renderer.parse_dockerfile('FROM alpine\n# escape=`\nRUN a \\\n b\n')
+    assert escape == '\\'
+    assert instructions[1].args == 'a  b'
+
+
+def test_parse_rejects_unknown_escape():
+    with pytest.raises(renderer.DockerfileError):
+        renderer.parse_dockerfile('# escape=x\nFROM alpine\n')
+
+
+def test_parse_keyword_is_case_insensitive():
+    escape, instructions = renderer.parse_dockerfile('from alpine\nrun true\n')
+    assert [i.keyword for i in instructions] == ['FROM', 'RUN']
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('$name', 'app'),
+    ('${name}-1', 'app-1'),
+    ('${missing}', ''),
+    ('${missing:-fallback}', 'fallback'),
+    ('${name:-fallback}', 'app'),
+    ('${missing:-$name}', 'app'),
+    ('${name:+set}', 'set'),
+    ('${missing:+set}', ''),
+    ('\\$name', '$name'),
+    ('cost $ 5', 'cost $ 5'),
+])
+def test_substitute(value, expected):
+    assert renderer.substitute(value, dict(name='app')) == expected
+
+
+def test_substitute_with_backtick_escape():
+    assert renderer.substitute('`$name $name', dict(name='app'), escape='`') == '$name app'
+
+
+def test_plan_chains_keys_on_the_layer_before(context):
+    text = 'FROM alpine\nRUN apk add curl\nCOPY src /app\nRUN true\n'
+    steps, _ = plan_text(text, context)
+    assert all(steps[i].key != steps[i + 1].key for i in range(len(steps) - 1))
+
+    changed, _ = plan_text(text.replace('curl', 'wget'), context)
+    assert changed[0].key == steps[0].key
+    assert all(a.key != b.key for a, b in zip(steps[1:], changed[1:]))
+
+
+def test_plan_copy_key_follows_file_content(context):
+    text = 'FROM alpine\nCOPY requirements.txt /\nCOPY src /app\n'
+    before, _ = plan_text(text, context)
+    assert before[2].files == ['src/app.py']
+
+    (context / 'src' / 'app.py').write_text('print(2)\n')
+    after, _ = plan_text(text, context)
+    assert keys(after)[:2] == keys(before)[:2]
+    assert after[2].key != before[2].key
+
+
+def test_plan_honours_dockerignore(context):
+    text = 'FROM alpine\nCOPY . /app\n'
+    before, _ = plan_text(text, context)
+    (context / '.dockerignore').write_text('src\n')
+    (context / 'src' / 'app.py').write_text('print(2)\n')
+    after, _ = plan_text(text, context)
+    assert 'src/app.py' not in after[1].files
+    assert before[1].key != after[1].key
+
+
+def test_plan_run_depends_on_build_args(context):
+    text = 'FROM alpine\nARG version=1\nRUN make\n'
+    default, _ = plan_text(text, context)
+    overridden, _ = plan_text(text, context, dict(version='2'))
+    assert overridden[2].rendered.text() == 'RUN make'
+    assert default[2].key != overridden[2].key
+
+
+def test_plan_renders_arg_and_env_values(context):
+    steps, _ = plan_text(
+        'ARG base=alpine\nFROM $base\nARG dir\nENV APP=/srv/${dir:-app}\nWORKDIR $APP\nLABEL path=$APP\n',
+        context,
+        dict(dir='web')
+    )
+    assert [step.rendered.text() for step in steps] == [
+        'ARG base=alpine',
+        'FROM alpine',
+        'ARG dir=web',
+        'ENV APP=/srv/web',
+        'WORKDIR /srv/web',
+        'LABEL path=/srv/web',
+    ]
+    # A global ARG is not a layer of its own.
+    assert steps[0].key is None
+
+
+def test_plan_copy_from_uses_the_stage_key(context):
+    text = 'FROM alpine AS build\nRUN make\nFROM scratch\nCOPY --from=build /out /out\n'
+    steps, stages = plan_text(text, context)
+    assert set(stages) == set(['build', '1'])
+
+    changed, changed_stages = plan_text(text.replace('make', 'make all'), context)
+    assert changed_stages['build'] != stages['build']
+    assert changed[2].key == steps[2].key
+    assert changed[3].key != steps[3].key
+
+
+def test_plan_rejects_instructions_before_from(context):
+    with pytest.raises(renderer.DockerfileError):
+        plan_text('RUN true\nFROM alpine\n', context)
+
+
+def optimize_text(text, context, volatile=()):
+    escape, instructions = renderer.parse_dockerfile(text)
+    hasher = renderer.ContextHasher(str(context))
+    instructions, changes = renderer.optimize(instructions, escape, hasher, list(volatile), {})
+    return [instruction.text() for instruction in instructions], changes
+
+
+def test_optimize_sinks_metadata_to_the_end_of_the_stage(context):
+    lines, changes = optimize_text(
+        'FROM alpine\nLABEL version=1\nEXPOSE 80\nRUN apk add curl\nCOPY src /app\nCMD ["app"]\n',
+        context
+    )
+    assert lines == [
+        'FROM alpine', 'RUN apk add curl', 'COPY src /app', 'LABEL version=1', 'EXPOSE 80', 'CMD ["app"]'
+    ]
+    assert changes == ['line 2: LABEL moved after RUN, COPY', 'line 3: EXPOSE moved after RUN, COPY']
+
+
+def test_optimize_keeps_metadata_edits_off_the_expensive_layers(context):
+    text = 'FROM alpine\nLABEL version=%s\nRUN apk add curl\nCOPY src /app\n'
+    first = renderer.render('\\', renderer.parse_dockerfile(text % '1')[1])
+    second = renderer.render('\\', renderer.parse_dockerfile(text % '2')[1])
+    assert keys(plan_text(first, context)[0])[1] != keys(plan_text(second, context)[0])[1]
+
+    optimized = [
+        '\n'.join(optimize_text(text % version, context)[0]) + '\n' for version in ('1', '2')
+    ]
+    before, _ = plan_text(optimized[0], context)
+    after, _ = plan_text(optimized[1], context)
+    assert keys(before)[:3] == keys(after)[:3]
+    assert before[3].key != after[3].key
+
+
+@pytest.mark.parametrize('blocker', ['ENV PORT=80', 'ARG PORT=80', 'SHELL ["/bin/bash", "-c"]'])
+def test_optimize_does_not_sink_metadata_past_what_changes_it(context, blocker):
+    lines, _ = optimize_text('FROM alpine\nEXPOSE 80\nRUN true\n%s\nRUN false\n' % blocker, context)
+    assert lines == ['FROM alpine', 'RUN true', 'EXPOSE 80', blocker, 'RUN false']
+
+
+def test_optimize_stops_at_the_next_stage(context):
+    lines, _ = optimize_text('FROM alpine AS build\nLABEL stage=build\nRUN make\nFROM scratch\nRUN true\n', context)
+    assert lines == ['FROM alpine AS build', 'RUN make', 'LABEL stage=build', 'FROM scratch', 'RUN true']
+
+
+def test_optimize_keeps_entrypoint_before_cmd(context):
+    lines, _ = optimize_text('FROM alpine\nENTRYPOINT ["app"]\nCMD ["--help"]\nRUN true\n', context)
+    assert lines == ['FROM alpine', 'RUN true', 'ENTRYPOINT ["app"]', 'CMD ["--help"]']
+
+
+def test_optimize_replaces_add_of_plain_files(context):
+    lines, changes = optimize_text('FROM alpine\nADD src/app.py /app/\n', context)
+    assert lines == ['FROM alpine', 'COPY src/app.py /app/']
+    assert changes == ['line 2: ADD of plain files replaced with COPY']
+
+
+def test_optimize_splits_volatile_sources(context):
+    lines, _ = optimize_text('FROM alpine\nCOPY requirements.txt src /app/\n', context, volatile=['src'])
+    assert lines == ['FROM alpine', 'COPY requirements.txt /app/', 'COPY src /app/']